@@ -0,0 +1 @@
+"""Code shared by the ChainShare rag-server and key-server."""
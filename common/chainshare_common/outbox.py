@@ -0,0 +1,240 @@
+"""Durable outbox for contract transactions.
+
+Request handlers only record what has to be sent. A single worker thread merges
+due items into batched transactions, submits them and checks their receipts on
+later ticks, so neither request threads nor the worker ever sleep on the chain.
+Items survive restarts: pending ones are sent and submitted ones are re-checked
+once the worker runs again.
+"""
+import json
+import threading
+import time
+import uuid
+from web3 import Web3
+from web3.exceptions import TransactionNotFound
+
+PENDING = "pending"
+SUBMITTED = "submitted"
+DONE = "done"
+FAILED = "failed"
+
+OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chain_outbox (
+        item_id VARCHAR PRIMARY KEY,
+        kind VARCHAR NOT NULL,
+        payload VARCHAR NOT NULL,
+        status VARCHAR NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        isolated BOOLEAN NOT NULL DEFAULT FALSE,
+        not_before DOUBLE NOT NULL,
+        tx_hash VARCHAR,
+        submitted_at DOUBLE,
+        last_error VARCHAR,
+        created_at DOUBLE NOT NULL,
+        updated_at DOUBLE NOT NULL
+    )
+"""
+
+
+class ChainOutbox:
+    """Queue of contract calls persisted in the `chain_outbox` table.
+
+    `mergers` maps an item kind to a function taking the due items of that kind
+    as (item_id, payload) pairs and returning batches of
+    (item_ids, contract_function, gas); gas may be None for the gateway default.
+    Every item must be in exactly one batch. When a batch of several items
+    reverts, its items are retried one by one so a single bad item cannot hold
+    back the others.
+
+    `transactions` is a Prometheus counter labelled by kind and outcome, and
+    `items` a gauge labelled by kind and status.
+    """
+
+    def __init__(self, conn, transaction, gateway, mergers, transactions, items, poll_interval=1.0,
+                 batch_limit=100, max_attempts=8, base_backoff=2.0, max_backoff=300.0,
+                 receipt_timeout=300.0, retention=86400.0):
+        self.conn = conn
+        self.transaction = transaction
+        self.gateway = gateway
+        self.mergers = mergers
+        self.transactions = transactions
+        self.items = items
+        self.poll_interval = poll_interval
+        self.batch_limit = batch_limit
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.receipt_timeout = receipt_timeout
+        self.retention = retention
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enqueue(self, kind, payload, delay=0.0, cursor=None):
+        """Persist one item, to be sent no earlier than `delay` seconds from now.
+
+        Must not be called while `cursor` is inside an open transaction.
+        """
+        if kind not in self.mergers:
+            raise ValueError(f"Unknown outbox item kind: {kind}")
+        own_cursor = cursor is None
+        cursor = self.conn.cursor() if own_cursor else cursor
+        now = time.time()
+        try:
+            with self.transaction(cursor):
+                cursor.execute("""
+                    INSERT INTO chain_outbox
+                    (item_id, kind, payload, status, not_before, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (str(uuid.uuid4()), kind, json.dumps(payload), PENDING, now + delay, now, now))
+        finally:
+            if own_cursor:
+                cursor.close()
+        if not delay:
+            self._wake.set()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="chain-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.process_once()
+            except Exception as e:
+                print(f"Chain outbox tick failed: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def process_once(self):
+        """Confirm submitted transactions, then submit the items that are due."""
+        cursor = self.conn.cursor()
+        try:
+            self._confirm_submitted(cursor)
+            self._submit_due(cursor)
+            self._purge_finished(cursor)
+            self._update_gauges(cursor)
+        finally:
+            cursor.close()
+
+    def _confirm_submitted(self, cursor):
+        submitted = cursor.execute("""
+            SELECT tx_hash, ANY_VALUE(kind), LIST(item_id), MIN(submitted_at)
+            FROM chain_outbox
+            WHERE status = ?
+            GROUP BY tx_hash
+        """, [SUBMITTED]).fetchall()
+
+        for tx_hash, kind, item_ids, submitted_at in submitted:
+            try:
+                receipt = self.gateway.web3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                if time.time() - submitted_at > self.receipt_timeout:
+                    self.transactions.labels(kind, "timeout").inc()
+                    self._retry(cursor, item_ids, f"No receipt for {tx_hash} after {self.receipt_timeout}s")
+                continue
+
+            if receipt["status"] == 1:
+                self.transactions.labels(kind, "success").inc()
+                self._set_status(cursor, item_ids, DONE)
+            else:
+                self.transactions.labels(kind, "reverted").inc()
+                self._retry(cursor, item_ids, f"Transaction {tx_hash} reverted", isolate=len(item_ids) > 1)
+
+    def _submit_due(self, cursor):
+        due = cursor.execute("""
+            SELECT item_id, kind, payload, isolated
+            FROM chain_outbox
+            WHERE status = ? AND not_before <= ?
+            ORDER BY created_at
+            LIMIT ?
+        """, (PENDING, time.time(), self.batch_limit)).fetchall()
+
+        groups = {}
+        for item_id, kind, payload, isolated in due:
+            item = (item_id, json.loads(payload))
+            if isolated:
+                groups.setdefault((kind, item_id), []).append(item)
+            else:
+                groups.setdefault((kind, None), []).append(item)
+
+        for (kind, _), items in groups.items():
+            try:
+                batches = self.mergers[kind](items)
+            except Exception as e:
+                self._retry(cursor, [item_id for item_id, _ in items], f"Could not build transaction: {e}")
+                continue
+
+            for item_ids, contract_function, gas in batches:
+                try:
+                    if gas is None:
+                        tx_hash = self.gateway.send(contract_function)
+                    else:
+                        tx_hash = self.gateway.send(contract_function, gas)
+                except Exception as e:
+                    self.transactions.labels(kind, "send_failed").inc()
+                    self._retry(cursor, item_ids, str(e))
+                    continue
+                with self.transaction(cursor):
+                    cursor.execute("""
+                        UPDATE chain_outbox
+                        SET status = $1, tx_hash = $2, submitted_at = $3, updated_at = $3
+                        WHERE item_id IN (SELECT UNNEST($4::VARCHAR[]))
+                    """, (SUBMITTED, Web3.to_hex(tx_hash), time.time(), item_ids))
+
+    def _retry(self, cursor, item_ids, error, isolate=False):
+        """Schedule the items again with exponential backoff, or give up after max_attempts."""
+        now = time.time()
+        with self.transaction(cursor):
+            cursor.execute("""
+                UPDATE chain_outbox
+                SET
+                    attempts = attempts + 1,
+                    status = CASE WHEN attempts + 1 >= $1 THEN $2 ELSE $3 END,
+                    not_before = $4 + LEAST($5 * POW(2, attempts), $6),
+                    isolated = isolated OR $7,
+                    tx_hash = NULL,
+                    submitted_at = NULL,
+                    last_error = $8,
+                    updated_at = $4
+                WHERE item_id IN (SELECT UNNEST($9::VARCHAR[]))
+            """, (self.max_attempts, FAILED, PENDING, now, self.base_backoff, self.max_backoff,
+                  isolate, error, item_ids))
+        print(f"Chain outbox items {item_ids} failed: {error}")
+
+    def _set_status(self, cursor, item_ids, status):
+        with self.transaction(cursor):
+            cursor.execute("""
+                UPDATE chain_outbox
+                SET status = $1, updated_at = $2
+                WHERE item_id IN (SELECT UNNEST($3::VARCHAR[]))
+            """, (status, time.time(), item_ids))
+
+    def _purge_finished(self, cursor):
+        # Failed items are kept for inspection
+        with self.transaction(cursor):
+            cursor.execute("""
+                DELETE FROM chain_outbox
+                WHERE status = ? AND updated_at < ?
+            """, (DONE, time.time() - self.retention))
+
+    def _update_gauges(self, cursor):
+        counts = {
+            (kind, status): count
+            for kind, status, count in cursor.execute("""
+                SELECT kind, status, COUNT(*)
+                FROM chain_outbox
+                WHERE status IN (?, ?, ?)
+                GROUP BY kind, status
+            """, (PENDING, SUBMITTED, FAILED)).fetchall()
+        }
+        for kind in self.mergers:
+            for status in (PENDING, SUBMITTED, FAILED):
+                self.items.labels(kind, status).set(counts.get((kind, status), 0))
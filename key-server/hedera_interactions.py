@@ -1,78 +1,112 @@
 import os
-import json
 from web3 import Web3
 from dotenv import load_dotenv
-import asyncio
+from contract_gateway import ContractGateway
+from chainshare_common.outbox import ChainOutbox
+from key_requests import KeyRequestIndex
+from metrics import CHAIN_TRANSACTIONS, KEY_REQUEST_LOOKUPS, OUTBOX_ITEMS, timed
 
 load_dotenv()
 
 KEY_SERVER_PUBLIC_KEY = os.getenv("KEY_SERVER_PUBLIC_KEY")
-KEY_CONTRACT_ADDRESS = os.getenv('KEY_CONTRACT_ADDRESS')
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+KEY_REQUEST_POLL_INTERVAL = float(os.getenv("KEY_REQUEST_POLL_INTERVAL", 1))
+KEY_REQUEST_LOG_BLOCK_RANGE = int(os.getenv("KEY_REQUEST_LOG_BLOCK_RANGE", 1000))
+
+# Shared contract gateway, transaction outbox and key request index, created once at startup
+gateway = None
+outbox = None
+key_requests = None
+
+def init_gateway():
+    global gateway
+    gateway = ContractGateway.from_env()
+    return gateway
 
 def get_chunk_key_request():
-    # Convert the address to checksum format
-    address = Web3.to_checksum_address(KEY_CONTRACT_ADDRESS)
-    
-    # Load the ABI from the JSON file
-    with open('./contract/KeyContract.json') as f:
-        abi = json.load(f)['abi']
-    
-    # Initialize a Web3 instance
-    web3 = Web3(Web3.HTTPProvider(os.getenv("RELAY_ENDPOINT")))
-    
-    # Add the operator's private key to the wallet
-    wallet = web3.eth.account.from_key(os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Initialize the contract
-    KeyContract = web3.eth.contract(address=address, abi=abi)
-    
     # Call the contract method
-    call_res = KeyContract.functions.getChunkKeyRequest(KEY_SERVER_PUBLIC_KEY).call({'from': wallet.address, 'gas': 300000})
+    with timed("get_chunk_key_request"):
+        call_res = gateway.call(gateway.functions.getChunkKeyRequest(KEY_SERVER_PUBLIC_KEY))
     
     # Print the result of the contract call
     print(f"Contract call result: {call_res}")
 
     return call_res
-    
 
-def publish_chunk_keys(chunk_ids, keys, key_owner):
-    # Convert the address to checksum format
-    address = Web3.to_checksum_address(KEY_CONTRACT_ADDRESS)
 
+def init_key_request_index(conn, transaction):
+    global key_requests
+    key_requests = KeyRequestIndex(
+        conn,
+        transaction,
+        gateway,
+        KEY_SERVER_PUBLIC_KEY,
+        poll_interval=KEY_REQUEST_POLL_INTERVAL,
+        max_block_range=KEY_REQUEST_LOG_BLOCK_RANGE
+    )
+    return key_requests
+
+
+def pending_chunk_ids(request_block=None):
+    """Chunk ids of this key server's open on-chain request.
+
+    With the block of the rag-server's requestChunkKeys receipt this is answered
+    from the local log index, otherwise or when the index cannot reach that block
+    the contract is read directly.
+    """
+    if request_block is not None:
+        with timed("key_request_index_lookup"):
+            chunk_ids = key_requests.pending_chunk_ids(request_block)
+        if chunk_ids is not None:
+            KEY_REQUEST_LOOKUPS.labels("index").inc()
+            return chunk_ids
+    KEY_REQUEST_LOOKUPS.labels("contract").inc()
+    return get_chunk_key_request()
+
+
+PUBLISH_CHUNK_KEYS = "publishChunkKeys"
+
+# publishChunkKeys stores every key and opens a rating per chunk, so gas grows with the ids
+PUBLISH_BASE_GAS = 150000
+PUBLISH_GAS_PER_CHUNK = 120000
+
+
+def init_outbox(conn, transaction):
+    global outbox
+    outbox = ChainOutbox(
+        conn,
+        transaction,
+        gateway,
+        {PUBLISH_CHUNK_KEYS: merge_publications},
+        CHAIN_TRANSACTIONS,
+        OUTBOX_ITEMS,
+        poll_interval=OUTBOX_POLL_INTERVAL,
+        max_attempts=OUTBOX_MAX_ATTEMPTS
+    )
+    return outbox
+
+
+def publish_chunk_keys(chunk_ids, keys, key_owner, cursor=None):
+    """Queue a publishChunkKeys transaction in the outbox."""
     # Convert key_owner to a list with checksum format
     key_owner = [Web3.to_checksum_address(owner) for owner in key_owner]
-    
-    # Load the ABI from the JSON file
-    with open('./contract/KeyContract.json') as f:
-        abi = json.load(f)['abi']
-    
-    # Initialize a Web3 instance
-    web3 = Web3(Web3.HTTPProvider(os.getenv("RELAY_ENDPOINT")))
-    
-    # Add the operator's private key to the wallet
-    wallet = web3.eth.account.from_key(os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Initialize the contract
-    KeyContract = web3.eth.contract(address=address, abi=abi)
+    outbox.enqueue(PUBLISH_CHUNK_KEYS, {"chunk_ids": chunk_ids, "keys": keys, "key_owners": key_owner}, cursor=cursor)
 
-    print(f"Chunk IDs: {chunk_ids}")
-    print(f"Keys: {keys}")
-    print(f"Key Owner: {key_owner}")
-    
-    # Prepare the transaction
-    transaction = KeyContract.functions.publishChunkKeys(chunk_ids, keys, key_owner).build_transaction({
-        'from': wallet.address,
-        'gas': 600000,
-        'nonce': web3.eth.get_transaction_count(wallet.address)
-    })
-    
-    # Sign the transaction with the operator's private key
-    signed_tx = web3.eth.account.sign_transaction(transaction, private_key=os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Send the transaction and wait for the result
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
-    tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-    
-    print(f"Updated call result: {tx_receipt}")
 
-    return tx_receipt
\ No newline at end of file
+def merge_publications(items):
+    """Outbox merger sending every publication as its own transaction, oldest first.
+
+    Each publication pays the key owners and opens the ratings of its request, so
+    none may be dropped. publishChunkKeys has to mirror the key server's current
+    on-chain request; the rag-server only sends the next requestChunkKeys once the
+    previous request is published.
+    """
+    return [
+        (
+            [item_id],
+            gateway.functions.publishChunkKeys(payload["chunk_ids"], payload["keys"], payload["key_owners"]),
+            PUBLISH_BASE_GAS + PUBLISH_GAS_PER_CHUNK * len(payload["chunk_ids"])
+        )
+        for item_id, payload in items
+    ]
@@ -0,0 +1,167 @@
+"""Local index of this key server's open on-chain key request.
+
+The contract keeps one pending request per key server, replaced by every
+requestChunkKeys and cleared by publishChunkKeys. Both emit events, which a
+poller thread follows block range by block range into `pending_key_requests`,
+so validating a key fetch is a local lookup instead of a contract read.
+"""
+import threading
+from web3 import Web3
+
+KEY_REQUEST_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pending_key_requests (
+        key_server VARCHAR PRIMARY KEY,
+        chunk_ids VARCHAR[] NOT NULL,
+        block_number BIGINT NOT NULL,
+        log_index INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS log_cursors (
+        name VARCHAR PRIMARY KEY,
+        block_number BIGINT NOT NULL
+    );
+"""
+
+CURSOR_NAME = "key_requests"
+
+
+def _topic(signature):
+    return Web3.to_hex(Web3.keccak(text=signature))
+
+
+REQUESTED_TOPIC = _topic("ChunkKeysRequested(address,string[],uint16[])")
+PUBLISHED_TOPIC = _topic("ChunkKeysPublished(address,string[],address[])")
+
+
+class KeyRequestIndex:
+    """Follows ChunkKeysRequested and ChunkKeysPublished logs for one key server.
+
+    Hedera has no reorgs, so every processed block is final and the cursor only
+    moves forward.
+    """
+
+    def __init__(self, conn, transaction, gateway, key_server, poll_interval=1.0, max_block_range=1000):
+        self.conn = conn
+        self.transaction = transaction
+        self.gateway = gateway
+        self.key_server = Web3.to_checksum_address(key_server)
+        self.poll_interval = poll_interval
+        self.max_block_range = max_block_range
+        self._key_server_topic = "0x" + "0" * 24 + self.key_server[2:].lower()
+        # Serialises catch-ups from the poller and from request threads
+        self._lock = threading.Lock()
+        self._indexed_block = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="key-request-index", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.catch_up()
+            except Exception as e:
+                print(f"Key request index poll failed: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def pending_chunk_ids(self, min_block):
+        """Chunk ids of the open request as of at least `min_block`, empty if there is none.
+
+        When the poller has not reached `min_block` yet, the missing blocks are read
+        with a single eth_getLogs up to `min_block`. Returns None, for the caller to
+        read the contract instead, when that is not possible: before the index is
+        seeded, when the gap exceeds one log range, or when fetching the logs fails.
+        """
+        if self._indexed_block is None or self._indexed_block < min_block:
+            if self._indexed_block is None or min_block - self._indexed_block > self.max_block_range:
+                return None
+            try:
+                self.catch_up(min_block)
+            except Exception as e:
+                print(f"Key request index catch-up to block {min_block} failed: {e}")
+                return None
+        cursor = self.conn.cursor()
+        try:
+            row = cursor.execute(
+                "SELECT chunk_ids FROM pending_key_requests WHERE key_server = ?",
+                [self.key_server]
+            ).fetchone()
+        finally:
+            cursor.close()
+        return list(row[0]) if row else []
+
+    def catch_up(self, min_block=None):
+        """Process all logs up to the latest block, or only up to `min_block` if given.
+
+        With `min_block` the chain head is not queried, the block is known to exist
+        because it comes from a transaction receipt.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            try:
+                if self._indexed_block is None:
+                    self._indexed_block = self._load_or_seed_cursor(cursor)
+                if min_block is not None and self._indexed_block >= min_block:
+                    return self._indexed_block
+
+                target = min_block if min_block is not None else self.gateway.web3.eth.block_number
+                while self._indexed_block < target:
+                    to_block = min(target, self._indexed_block + self.max_block_range)
+                    logs = self.gateway.web3.eth.get_logs({
+                        "address": self.gateway.address,
+                        "fromBlock": self._indexed_block + 1,
+                        "toBlock": to_block,
+                        "topics": [[REQUESTED_TOPIC, PUBLISHED_TOPIC], self._key_server_topic]
+                    })
+                    with self.transaction(cursor):
+                        self._apply(cursor, logs)
+                        cursor.execute("""
+                            INSERT INTO log_cursors (name, block_number) VALUES (?, ?)
+                            ON CONFLICT (name) DO UPDATE SET block_number = excluded.block_number
+                        """, (CURSOR_NAME, to_block))
+                    self._indexed_block = to_block
+                return self._indexed_block
+            finally:
+                cursor.close()
+
+    def _load_or_seed_cursor(self, cursor):
+        row = cursor.execute("SELECT block_number FROM log_cursors WHERE name = ?", [CURSOR_NAME]).fetchone()
+        if row:
+            return row[0]
+
+        # First start: take the current request from the contract once and follow logs from here
+        latest = self.gateway.web3.eth.block_number
+        chunk_ids = self.gateway.call(self.gateway.functions.getChunkKeyRequest(self.key_server))
+        with self.transaction(cursor):
+            cursor.execute("DELETE FROM pending_key_requests WHERE key_server = ?", [self.key_server])
+            if chunk_ids:
+                cursor.execute("""
+                    INSERT INTO pending_key_requests (key_server, chunk_ids, block_number, log_index)
+                    VALUES (?, ?, ?, 0)
+                """, (self.key_server, list(chunk_ids), latest))
+            cursor.execute("INSERT INTO log_cursors (name, block_number) VALUES (?, ?)", (CURSOR_NAME, latest))
+        return latest
+
+    def _apply(self, cursor, logs):
+        events = self.gateway.contract.events
+        for log in sorted(logs, key=lambda log: (log["blockNumber"], log["logIndex"])):
+            topic = Web3.to_hex(log["topics"][0])
+            if topic == REQUESTED_TOPIC:
+                event = events.ChunkKeysRequested().process_log(log)
+                cursor.execute("""
+                    INSERT INTO pending_key_requests (key_server, chunk_ids, block_number, log_index)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key_server) DO UPDATE SET
+                        chunk_ids = excluded.chunk_ids,
+                        block_number = excluded.block_number,
+                        log_index = excluded.log_index
+                """, (self.key_server, list(event["args"]["chunkIds"]), log["blockNumber"], log["logIndex"]))
+            elif topic == PUBLISHED_TOPIC:
+                cursor.execute("DELETE FROM pending_key_requests WHERE key_server = ?", [self.key_server])
@@ -1,17 +1,29 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import duckdb
 import uvicorn
 import os
 from dotenv import load_dotenv
-from hedera_interactions import get_chunk_key_request, publish_chunk_keys
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from hedera_interactions import pending_chunk_ids, publish_chunk_keys, init_gateway, init_outbox, init_key_request_index
+from metrics import REQUEST_LATENCY, timed
+from chainshare_common.outbox import OUTBOX_SCHEMA
+from key_requests import KEY_REQUEST_SCHEMA
+from migrations import run_migrations
+from contextlib import contextmanager
+import threading
 import time
+import json
 load_dotenv()
 
 KEY_SERVER_SECRET = os.getenv('KEY_SERVER_SECRET')
 
+# Rows fetched from DuckDB per step while streaming a document's keys
+KEY_BUNDLE_FETCH_SIZE = 1000
+
 app = FastAPI()
 
 origins = ["*"]
@@ -24,21 +36,88 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency per route template
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status)
+        ).observe(time.perf_counter() - started)
+
+# Create the contract gateway once so every request reuses its connection and nonce counter
+init_gateway()
+
 # Initialize DuckDB
 db = duckdb.connect('keyserver.db')
 
-# Create table if it doesn't exist. The public_key will be the one that receives the rewards from the RAG server.
+# DuckDB runs concurrent readers in parallel but aborts conflicting writers,
+# so writes from different request threads are serialised
+write_lock = threading.Lock()
+
+@contextmanager
+def transaction(conn):
+    """Run the enclosed statements in one DuckDB write transaction, rolling back on error."""
+    with write_lock:
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# Create tables if they don't exist. The public_key will be the one that receives the rewards from the RAG server.
 db.execute("""
-    CREATE TABLE IF NOT EXISTS keys (
-        chunk_id VARCHAR,
-        document_id VARCHAR,
-        secret_key VARCHAR,
-        public_key VARCHAR
+    CREATE TABLE IF NOT EXISTS chunk_keys (
+        chunk_id VARCHAR PRIMARY KEY,
+        secret_key VARCHAR NOT NULL,
+        public_key VARCHAR NOT NULL,
+        document_id VARCHAR
+    );
+    CREATE TABLE IF NOT EXISTS document_keys (
+        document_id VARCHAR PRIMARY KEY,
+        secret_key VARCHAR NOT NULL,
+        public_key VARCHAR NOT NULL
     )
 """)
 
-#print keys database
-print(db.execute("SELECT * FROM keys WHERE document_id NOT NULL").fetchall())
+db.execute(OUTBOX_SCHEMA)
+db.execute(KEY_REQUEST_SCHEMA)
+
+run_migrations(db, transaction)
+
+# publishChunkKeys transactions are queued durably and sent by the outbox worker
+outbox = init_outbox(db, transaction)
+
+# Follows requestChunkKeys and publishChunkKeys logs so /get-keys/ does not read the contract
+key_requests = init_key_request_index(db, transaction)
+
+@app.on_event("startup")
+def start_background_workers():
+    outbox.start()
+    key_requests.start()
+
+@app.on_event("shutdown")
+def stop_background_workers():
+    key_requests.stop()
+    outbox.stop()
+
+def get_cursor():
+    """Per-request cursor so handlers running in the threadpool never share a connection."""
+    cursor = db.cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
 
 class KeyUploadRequest(BaseModel):
     chunkIds: List[str]
@@ -55,26 +134,37 @@ class KeyResponse(BaseModel):
 class ChunkIdsRequest(BaseModel):
     chunk_ids: List[str]
     whole_document: bool
+    # Block of the requestChunkKeys receipt, lets the key server answer from its log index
+    request_block: Optional[int] = None
 
 class DocumentIdRequest(BaseModel):
     document_id: str
     key_server_secret: str
 
+def _lookup_chunk_keys(cur, chunk_ids):
+    return cur.execute("""
+        SELECT chunk_id, secret_key, public_key
+        FROM chunk_keys
+        WHERE chunk_id IN (SELECT UNNEST(?::VARCHAR[]))
+    """, [list(chunk_ids)]).fetchall()
+
 @app.post("/upload-keys")
-async def upload_keys(request: KeyUploadRequest):
+def upload_keys(request: KeyUploadRequest, cur=Depends(get_cursor)):
     if len(request.chunkIds) != len(request.encryptionKeys):
         raise HTTPException(status_code=400, detail="Mismatch between document IDs and encryption keys")
 
     try:
-        for chunk_id, secret_key in zip(request.chunkIds, request.encryptionKeys):
-            db.execute("""
-                INSERT INTO keys (chunk_id, document_id, secret_key, public_key)
-                VALUES (?, ?, ?, ?)
-            """, (chunk_id,None, secret_key, request.publicKey))
-        db.execute("""
-                INSERT INTO keys (chunk_id, document_id, secret_key, public_key)
-                VALUES (?, ?, ?, ?)
-            """, (None, request.documentId, request.documentKey, request.publicKey))
+        # A repeated chunk id keeps its last key, DuckDB cannot replace the same row twice in one statement
+        keys_by_chunk = dict(zip(request.chunkIds, request.encryptionKeys))
+        with transaction(cur):
+            cur.execute("""
+                INSERT OR REPLACE INTO chunk_keys (chunk_id, secret_key, public_key, document_id)
+                SELECT UNNEST($1::VARCHAR[]), UNNEST($2::VARCHAR[]), $3, $4
+            """, (list(keys_by_chunk.keys()), list(keys_by_chunk.values()), request.publicKey, request.documentId))
+            cur.execute("""
+                INSERT OR REPLACE INTO document_keys (document_id, secret_key, public_key)
+                VALUES (?, ?, ?)
+            """, (request.documentId, request.documentKey, request.publicKey))
         
         return {"message": "Keys uploaded successfully"}
     except Exception as e:
@@ -82,29 +172,40 @@ async def upload_keys(request: KeyUploadRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/get-keys/", response_model=List[KeyResponse])
-async def get_keys(request: ChunkIdsRequest, background_tasks: BackgroundTasks):
+def get_keys(request: ChunkIdsRequest, cur=Depends(get_cursor)):
     try:
-        onChain_chunk_ids = get_chunk_key_request()
         chunk_ids = request.chunk_ids
+        # Whole-document fetches are not tied to an on-chain request
+        onChain_chunk_ids = [] if request.whole_document else pending_chunk_ids(request.request_block)
+        if(not request.whole_document and request.request_block is not None and not set(chunk_ids).issubset(onChain_chunk_ids)):
+            # Contracts deployed before the request events never show up in the index, confirm with a direct read
+            onChain_chunk_ids = pending_chunk_ids()
         
-        if(not request.whole_document and onChain_chunk_ids != chunk_ids):
+        # The RAG server batches concurrent queries into one on-chain request, so a
+        # request only has to be covered by it rather than match it exactly
+        if(not request.whole_document and not set(chunk_ids).issubset(onChain_chunk_ids)):
             raise HTTPException(status_code=400, detail="Mismatch between requested chunk ids and on-chain chunk ids")
             
-        query = f"SELECT chunk_id, secret_key, public_key FROM keys WHERE chunk_id IN ({','.join(['?'] * len(chunk_ids))})"
-        results = db.execute(query, chunk_ids).fetchall()
+        with timed("key_lookup"):
+            results = _lookup_chunk_keys(cur, chunk_ids)
         
         if not results:
             raise HTTPException(status_code=404, detail="No matching document IDs found")
             
-        # Move response creation before background task
+        # Build the response before queueing the publication
         response = [KeyResponse(chunk_id=row[0], secret_key=row[1], public_key=row[2]) for row in results]
         
         if not request.whole_document:
-            background_tasks.add_task(
-                publish_chunk_keys,
-                [row[0] for row in results],
-                [row[1] for row in results],
-                [row[2] for row in results]
+            # publishChunkKeys has to mirror the full on-chain request in its original order
+            if set(onChain_chunk_ids) != set(chunk_ids):
+                results = _lookup_chunk_keys(cur, onChain_chunk_ids)
+            rows_by_chunk = {row[0]: row for row in results}
+            published = [rows_by_chunk[chunk_id] for chunk_id in onChain_chunk_ids if chunk_id in rows_by_chunk]
+            publish_chunk_keys(
+                [row[0] for row in published],
+                [row[1] for row in published],
+                [row[2] for row in published],
+                cursor=cur
             )
             
         return response
@@ -114,13 +215,51 @@ async def get_keys(request: ChunkIdsRequest, background_tasks: BackgroundTasks):
     
 # Get keys for a document id
 @app.post("/get-keys-for-document")
-async def get_keys_for_document(request: DocumentIdRequest):
+def get_keys_for_document(request: DocumentIdRequest, cur=Depends(get_cursor)):
     if request.key_server_secret != KEY_SERVER_SECRET:
         raise HTTPException(status_code=401, detail="Invalid key server secret")
-    results = db.execute("SELECT secret_key FROM keys WHERE document_id = ?", [request.document_id]).fetchall()
-    return results[0][0]
+    result = cur.execute("SELECT secret_key FROM document_keys WHERE document_id = ?", [request.document_id]).fetchone()
+    if result is None:
+        raise HTTPException(status_code=404, detail="No key found for document")
+    return result[0]
+
+def _document_key_lines(document_id, document_key):
+    yield json.dumps({"document_id": document_id, "secret_key": document_key}) + "\n"
+    # The request cursor is closed when the handler returns, so the stream reads through its own
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            "SELECT chunk_id, secret_key, public_key FROM chunk_keys WHERE document_id = ?",
+            [document_id]
+        )
+        while True:
+            rows = cursor.fetchmany(KEY_BUNDLE_FETCH_SIZE)
+            if not rows:
+                break
+            yield "".join(
+                json.dumps({"chunk_id": row[0], "secret_key": row[1], "public_key": row[2]}) + "\n"
+                for row in rows
+            )
+    finally:
+        cursor.close()
+
+# Document key and all chunk keys of a document in one NDJSON response
+@app.post("/get-document-keys")
+def get_document_keys(request: DocumentIdRequest, cur=Depends(get_cursor)):
+    if request.key_server_secret != KEY_SERVER_SECRET:
+        raise HTTPException(status_code=401, detail="Invalid key server secret")
+    result = cur.execute("SELECT secret_key FROM document_keys WHERE document_id = ?", [request.document_id]).fetchone()
+    if result is None:
+        raise HTTPException(status_code=404, detail="No key found for document")
+    return StreamingResponse(_document_key_lines(request.document_id, result[0]), media_type="application/x-ndjson")
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8001))
+    # DuckDB allows a single read-write process per database file, so handlers
+    # run as plain functions in the threadpool with one cursor each instead of workers
     uvicorn.run("key_server:app", host="0.0.0.0", port=port, workers=1)
\ No newline at end of file
@@ -0,0 +1,38 @@
+"""Prometheus metrics of the key-server, exposed in text format on /metrics."""
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+# Covers everything from in-memory lookups to on-chain receipt waits
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "key_server_http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    "key_server_stage_duration_seconds", "Latency of the individual stages of request processing",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+CHAIN_TRANSACTIONS = Counter(
+    "key_server_chain_transactions_total", "Contract transactions sent, by contract function and outcome",
+    ["function", "outcome"]
+)
+OUTBOX_ITEMS = Gauge(
+    "key_server_outbox_items", "Contract transactions in the outbox, by kind and status", ["kind", "status"]
+)
+KEY_REQUEST_LOOKUPS = Counter(
+    "key_server_key_request_lookups_total", "Lookups of the open on-chain key request, by source",
+    ["source"]
+)
+
+
+@contextmanager
+def timed(stage):
+    """Record the duration of the enclosed block under `stage`, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
@@ -0,0 +1,71 @@
+"""Versioned schema migrations for the key-server DuckDB database.
+
+Every migration runs once, in its own transaction, and is recorded in
+`schema_version`. Append new migrations to MIGRATIONS with the next version
+number; never edit or reorder ones that have already shipped.
+"""
+
+
+def _split_keys(conn):
+    # Chunk and document keys used to share one `keys` table, each row with a
+    # NULL in the other id column. Re-uploads added duplicates, the last one wins.
+    legacy = conn.execute("""
+        SELECT COUNT(*) FROM information_schema.tables
+        WHERE table_schema = 'main' AND table_name = 'keys'
+    """).fetchone()[0]
+    if not legacy:
+        return
+
+    conn.execute("""
+        INSERT INTO chunk_keys (chunk_id, secret_key, public_key)
+        SELECT chunk_id, secret_key, public_key
+        FROM keys
+        WHERE chunk_id IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY chunk_id ORDER BY rowid DESC) = 1;
+
+        INSERT INTO document_keys (document_id, secret_key, public_key)
+        SELECT document_id, secret_key, public_key
+        FROM keys
+        WHERE document_id IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY rowid DESC) = 1;
+
+        DROP TABLE keys;
+    """)
+
+
+def _chunk_key_documents(conn):
+    # Keys moved from the old `keys` table have no document id, the rag-server
+    # fetches those by chunk id instead
+    conn.execute("""
+        ALTER TABLE chunk_keys ADD COLUMN IF NOT EXISTS document_id VARCHAR;
+        CREATE INDEX IF NOT EXISTS idx_chunk_keys_document_id ON chunk_keys(document_id);
+    """)
+
+
+MIGRATIONS = [
+    (1, "Separate chunk and document key tables", _split_keys),
+    (2, "Document ids on chunk keys", _chunk_key_documents),
+]
+
+
+def run_migrations(conn, transaction):
+    """Apply every migration newer than the database's schema version."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT current_timestamp
+        )
+    """)
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        with transaction(conn):
+            migrate(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+        print(f"Applied schema migration {version}: {description}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The server modules are imported from the service directory, as when running key_server.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
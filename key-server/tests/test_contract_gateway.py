@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+import pytest
+from contract_gateway import ContractGateway, NonceManager
+
+OPERATOR = "0x" + "22" * 20
+
+
+class FakeEth:
+    def __init__(self, send_error=None):
+        self.send_error = send_error
+        self.sent = []
+        self.account = SimpleNamespace(
+            sign_transaction=lambda transaction, private_key: SimpleNamespace(raw_transaction=transaction)
+        )
+
+    def get_transaction_count(self, address, block_identifier):
+        return 7
+
+    def send_raw_transaction(self, raw_transaction):
+        if self.send_error is not None:
+            error, self.send_error = self.send_error, None
+            raise error
+        self.sent.append(raw_transaction)
+        return b"tx"
+
+
+class FakeFunction:
+    def __init__(self, error=None):
+        self.error = error
+
+    def build_transaction(self, transaction):
+        if self.error is not None:
+            raise self.error
+        return transaction
+
+
+def make_gateway(eth):
+    gateway = ContractGateway.__new__(ContractGateway)
+    gateway.private_key = "0x" + "33" * 32
+    gateway.account = SimpleNamespace(address=OPERATOR)
+    gateway.web3 = SimpleNamespace(eth=eth)
+    gateway.nonces = NonceManager(gateway.web3, OPERATOR)
+    return gateway
+
+
+def test_failed_build_returns_nonce():
+    eth = FakeEth()
+    gateway = make_gateway(eth)
+
+    with pytest.raises(ValueError):
+        gateway.send(FakeFunction(ValueError("execution reverted")))
+    gateway.send(FakeFunction())
+
+    assert [transaction["nonce"] for transaction in eth.sent] == [7]
+
+
+def test_failure_after_broadcast_keeps_nonce():
+    eth = FakeEth(send_error=TimeoutError("relay timed out"))
+    gateway = make_gateway(eth)
+
+    with pytest.raises(TimeoutError):
+        gateway.send(FakeFunction())
+    gateway.send(FakeFunction())
+
+    assert [transaction["nonce"] for transaction in eth.sent] == [8]
+
+
+def test_nonce_error_after_broadcast_resets_nonce():
+    eth = FakeEth(send_error=ValueError("nonce too low"))
+    gateway = make_gateway(eth)
+
+    with pytest.raises(ValueError):
+        gateway.send(FakeFunction())
+    gateway.send(FakeFunction())
+
+    assert [transaction["nonce"] for transaction in eth.sent] == [7]
+
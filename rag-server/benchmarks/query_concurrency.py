@@ -0,0 +1,73 @@
+"""Measure /query throughput at increasing levels of concurrency.
+
+Fires the same number of random-embedding queries at a running RAG server for
+each concurrency level and prints requests per second, so the effect of the
+non-blocking query pipeline can be compared against a single in-flight query.
+
+Usage:
+    python benchmarks/query_concurrency.py --secret $RAG_SERVER_SECRET --public-key 0x... --dim 1536
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import httpx
+
+
+async def _run_level(client, url, payloads, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(payload):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(url, json=payload)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(payload) for payload in payloads))
+    elapsed = time.perf_counter() - started
+    return elapsed, latencies, failures
+
+
+async def main(args):
+    url = f"{args.url.rstrip('/')}/query"
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        print(f"{'concurrency':>12} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'errors':>8}")
+        for concurrency in levels:
+            payloads = [
+                {
+                    "ragServerSecret": args.secret,
+                    "publicKey": args.public_key,
+                    "n_results": args.n_results,
+                    "query_embedding": [random.uniform(-1, 1) for _ in range(args.dim)],
+                }
+                for _ in range(args.requests)
+            ]
+            elapsed, latencies, failures = await _run_level(client, url, payloads, concurrency)
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+            print(f"{concurrency:>12} {len(payloads) / elapsed:>10.2f} "
+                  f"{statistics.median(latencies) * 1000:>10.1f} {p95 * 1000:>10.1f} {failures:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.getenv("RAG_SERVER_API", "http://localhost:8000"))
+    parser.add_argument("--secret", default=os.getenv("RAG_SERVER_SECRET"))
+    parser.add_argument("--public-key", required=True)
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension of the collection")
+    parser.add_argument("--n-results", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=32, help="Queries sent per concurrency level")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="Comma separated concurrency levels")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(main(parser.parse_args()))
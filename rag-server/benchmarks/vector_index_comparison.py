@@ -0,0 +1,100 @@
+"""Compare recall and latency of the Chroma and memory-mapped vector indexes.
+
+Builds both indexes in a temporary directory from the same random corpus (or
+from the embeddings of an existing Chroma collection), runs the same queries
+against each and reports query latency and recall@k against exact search.
+The mmap index is exact, so its recall should always be 1.0.
+
+Usage:
+    python benchmarks/vector_index_comparison.py --corpus 20000 --dim 1536 --queries 200 --k 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.vector_index import ChromaVectorIndex, MmapVectorIndex
+
+
+def _exact_top_k(corpus, queries, k):
+    distances = (corpus ** 2).sum(axis=1)[None, :] + (queries ** 2).sum(axis=1)[:, None] - 2.0 * queries @ corpus.T
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+def _benchmark(index, queries, k, batch_size):
+    latencies = []
+    results = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        started = time.perf_counter()
+        response = index.query(batch, k)
+        latencies.append((time.perf_counter() - started) / len(batch))
+        results.extend(response["ids"])
+    return latencies, results
+
+
+def _load_corpus(args):
+    if args.chroma_path:
+        import chromadb
+        collection = chromadb.PersistentClient(path=args.chroma_path).get_collection(args.collection)
+        data = collection.get(include=["embeddings"])
+        return data["ids"], np.asarray(data["embeddings"], dtype=np.float32)
+    rng = np.random.default_rng(args.seed)
+    return [f"chunk-{i}" for i in range(args.corpus)], rng.standard_normal((args.corpus, args.dim), dtype=np.float32)
+
+
+def main(args):
+    ids, corpus = _load_corpus(args)
+    rng = np.random.default_rng(args.seed + 1)
+    # Queries near existing vectors resemble real retrieval better than pure noise
+    picks = rng.integers(0, len(corpus), args.queries)
+    queries = corpus[picks] + rng.normal(0, args.noise, (args.queries, corpus.shape[1])).astype(np.float32)
+
+    truth = _exact_top_k(corpus, queries, args.k)
+    row_by_id = {chunk_id: row for row, chunk_id in enumerate(ids)}
+
+    workdir = tempfile.mkdtemp()
+    try:
+        indexes = {
+            "chroma": ChromaVectorIndex(os.path.join(workdir, "chroma"), "benchmark"),
+            "mmap": MmapVectorIndex(os.path.join(workdir, "mmap")),
+        }
+        print(f"corpus={len(ids)} dim={corpus.shape[1]} queries={args.queries} k={args.k}")
+        print(f"{'backend':>8} {'build s':>9} {'p50 ms':>9} {'p95 ms':>9} {'recall':>8}")
+        for name, index in indexes.items():
+            started = time.perf_counter()
+            for start in range(0, len(ids), args.add_batch):
+                index.add(ids[start:start + args.add_batch], corpus[start:start + args.add_batch])
+            build = time.perf_counter() - started
+
+            latencies, results = _benchmark(index, queries, args.k, args.batch)
+            recall = np.mean([
+                len({row_by_id[chunk_id] for chunk_id in found} & expected) / args.k
+                for found, expected in zip(results, truth)
+            ])
+            latencies.sort()
+            p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+            print(f"{name:>8} {build:>9.2f} {np.median(latencies) * 1000:>9.3f} {p95 * 1000:>9.3f} {recall:>8.4f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=int, default=20000, help="Random corpus size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=1, help="Query embeddings per index call")
+    parser.add_argument("--add-batch", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chroma-path", help="Use the embeddings of an existing Chroma store instead of random data")
+    parser.add_argument("--collection", default=os.getenv("COLLECTION_NAME", "rag"))
+    main(parser.parse_args())
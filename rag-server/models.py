@@ -1,8 +1,10 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import duckdb
 import os
 from dotenv import load_dotenv
+from utils.document_stats import refresh_document_stats
+from utils.migrations import run_migrations
 
 load_dotenv()
 
@@ -10,7 +12,9 @@ DUCKDB_PATH = os.getenv('DUCKDB_PATH', 'rag.db')
 
 class DocumentChunk(BaseModel):
     id: str
-    embedding: List[float]
+    embedding: Optional[List[float]] = None
+    # Base64 little-endian float32 alternative to the JSON float list
+    embedding_b64: Optional[str] = None
     encrypted_content: str
 
 class DocumentUpload(BaseModel):
@@ -20,7 +24,9 @@ class DocumentUpload(BaseModel):
     documentTitle: str
     keyServerPublicKey: str
     ragServerSecret: str
-    encryptedDocument: str
+    embeddingDim: Optional[int] = None
+    # Optional when the blob was streamed to /upload_document_blob beforehand
+    encryptedDocument: Optional[str] = None
 
 class DeleteDocumentRequest(BaseModel):
     ragServerSecret: str
@@ -29,7 +35,22 @@ class DeleteDocumentRequest(BaseModel):
 
 class QueryRequest(BaseModel):
     ragServerSecret: str
-    query_embedding: List[float]
+    query_embedding: Optional[List[float]] = None
+    query_embedding_b64: Optional[str] = None
+    embedding_dim: Optional[int] = None
+    publicKey: str
+    n_results: int = 2
+    # Large-k mode: page through the n_results best chunks, page_size at a time
+    page_size: Optional[int] = None
+    cursor: Optional[str] = None
+    # "full", "preview" (first 100 characters) or "ids" (no content, no key purchase)
+    content: str = "full"
+
+class BatchQueryRequest(BaseModel):
+    ragServerSecret: str
+    query_embeddings: Optional[List[List[float]]] = None
+    query_embeddings_b64: Optional[List[str]] = None
+    embedding_dim: Optional[int] = None
     publicKey: str
     n_results: int = 2
 
@@ -44,6 +65,15 @@ class ChunkRating(BaseModel):
     chunkId: str
     rating: int
 
+class ChunkRatingItem(BaseModel):
+    chunkId: str
+    rating: int
+
+class ChunkRatingsBatch(BaseModel):
+    ragServerSecret: str
+    publicKey: str
+    ratings: List[ChunkRatingItem]
+
 class ChunkRatingsRequest(BaseModel):
     ragServerSecret: str
     chunkIds: List[str]
@@ -61,7 +91,8 @@ def init_database():
             encrypted BOOLEAN,
             reward FLOAT,
             public_key VARCHAR NOT NULL,
-            key_server_public_key VARCHAR NOT NULL
+            key_server_public_key VARCHAR NOT NULL,
+            ciphertext BLOB
         );
         CREATE TABLE IF NOT EXISTS documents (
             document_id VARCHAR PRIMARY KEY,
@@ -72,8 +103,24 @@ def init_database():
             rating_id VARCHAR PRIMARY KEY,
             public_key VARCHAR NOT NULL,
             chunk_id VARCHAR NOT NULL,
-            rating INTEGER NOT NULL DEFAULT 0
+            rating INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (chunk_id, public_key)
+        );
+        CREATE TABLE IF NOT EXISTS document_stats (
+            document_id VARCHAR PRIMARY KEY,
+            public_key VARCHAR NOT NULL,
+            total_chunks INTEGER NOT NULL DEFAULT 0,
+            encrypted_chunks INTEGER NOT NULL DEFAULT 0,
+            total_reward DOUBLE NOT NULL DEFAULT 0,
+            upvotes INTEGER NOT NULL DEFAULT 0,
+            downvotes INTEGER NOT NULL DEFAULT 0,
+            total_rating INTEGER NOT NULL DEFAULT 0
         );
     """)
+
+    run_migrations(conn)
+
+    # Databases created before document_stats existed get their stats computed once
+    refresh_document_stats(conn)
     
     return conn
@@ -1,10 +1,37 @@
 import os
+import sys
 from dotenv import load_dotenv
-from fastapi import FastAPI
+
+if __name__ == "__main__":
+    # Hand over to the uvicorn CLI before any setup runs. The server module is then
+    # imported once, as "rag_server", and spawned decryption workers, which re-import
+    # the main module, do not repeat the server setup.
+    load_dotenv()
+    # DuckDB allows a single read-write process per database file, so the server
+    # scales across cores with threads (THREADPOOL_SIZE) rather than workers
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "rag_server:app",
+        "--host", "0.0.0.0", "--port", os.environ.get("PORT", "8000"), "--workers", "1"
+    ])
+
+import time
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import chromadb
-import uvicorn
+import httpx
+import anyio
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from models import init_database
+from utils.contract_gateway import ContractGateway
+from utils.key_broker import KeyRequestBroker
+from utils.vector_index import create_vector_index
+from chainshare_common.outbox import ChainOutbox
+from utils.pdf_cache import PdfCache
+from utils.blob_store import BlobStore
+from utils.query_cache import QueryCache
+from utils.db import transaction
+from utils.hedera_interactions import RATE_KEY_OWNERS, merge_key_owner_ratings
+from utils.helpers import shutdown_decrypt_pool
+from utils.metrics import REQUEST_LATENCY, PENDING_KEY_REQUESTS, CHAIN_TRANSACTIONS, OUTBOX_ITEMS
 import state
 
 # Import the route modules
@@ -22,20 +49,74 @@ app = FastAPI()
 # Initialize shared state
 state.SharedState.CHROMA_PATH = os.getenv('CHROMA_PATH', 'chroma')
 state.SharedState.COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'rag')
+state.SharedState.VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma')
+state.SharedState.VECTOR_INDEX_PATH = os.getenv('VECTOR_INDEX_PATH', 'vectors')
 state.SharedState.RAG_SERVER_SECRET = os.getenv('RAG_SERVER_SECRET')
 state.SharedState.KEY_SERVER_SECRET = os.getenv('KEY_SERVER_SECRET')
 state.SharedState.PDF_STORAGE_PATH = os.getenv('PDF_STORAGE_PATH', 'documents')
 state.SharedState.KEY_SERVER_API = os.getenv('KEY_SERVER_API', 'http://localhost:8001')
 state.SharedState.MAX_CHUNK_PRICE = float(os.getenv('MAX_CHUNK_PRICE', 5))
+state.SharedState.MAX_QUERY_RESULTS = int(os.getenv('MAX_QUERY_RESULTS', 1000))
+THREADPOOL_SIZE = int(os.getenv('THREADPOOL_SIZE', 40))
+state.SharedState.VECTOR_ADD_BATCH_SIZE = int(os.getenv('VECTOR_ADD_BATCH_SIZE', 1000))
+state.SharedState.KEY_REQUEST_BATCH_WINDOW_MS = float(os.getenv('KEY_REQUEST_BATCH_WINDOW_MS', 50))
+state.SharedState.KEY_REQUEST_MAX_BATCH = int(os.getenv('KEY_REQUEST_MAX_BATCH', 100))
+state.SharedState.RATE_KEY_OWNERS_DELAY = float(os.getenv('RATE_KEY_OWNERS_DELAY', 10))
+KEY_PUBLICATION_TIMEOUT = float(os.getenv('KEY_PUBLICATION_TIMEOUT', 120))
+KEY_PUBLICATION_POLL_INTERVAL = float(os.getenv('KEY_PUBLICATION_POLL_INTERVAL', 1))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_BYTES', 1024 ** 3))
+BLOB_GC_INTERVAL = float(os.getenv('BLOB_GC_INTERVAL', 3600))
+BLOB_GC_GRACE = float(os.getenv('BLOB_GC_GRACE', 3600))
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 300))
+QUERY_CACHE_QUANTUM = float(os.getenv('QUERY_CACHE_QUANTUM', 1e-4))
+QUERY_CACHE_SIMILARITY = float(os.getenv('QUERY_CACHE_SIMILARITY', 0)) or None
 
 # Ensure directories exist
 os.makedirs(state.SharedState.CHROMA_PATH, exist_ok=True)
 os.makedirs(state.SharedState.PDF_STORAGE_PATH, exist_ok=True)
 
 # Initialize database connections
-chroma_client = chromadb.PersistentClient(path=state.SharedState.CHROMA_PATH)
-state.SharedState.collection = chroma_client.get_or_create_collection(name=state.SharedState.COLLECTION_NAME)
+state.SharedState.vector_index = create_vector_index(
+    state.SharedState.VECTOR_BACKEND,
+    state.SharedState.CHROMA_PATH,
+    state.SharedState.COLLECTION_NAME,
+    state.SharedState.VECTOR_INDEX_PATH
+)
 state.SharedState.conn = init_database()
+state.SharedState.gateway = ContractGateway.from_env()
+state.SharedState.outbox = ChainOutbox(
+    state.SharedState.conn,
+    transaction,
+    state.SharedState.gateway,
+    {RATE_KEY_OWNERS: merge_key_owner_ratings},
+    CHAIN_TRANSACTIONS,
+    OUTBOX_ITEMS,
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    max_attempts=OUTBOX_MAX_ATTEMPTS
+)
+state.SharedState.blob_store = BlobStore(
+    state.SharedState.conn,
+    state.SharedState.PDF_STORAGE_PATH,
+    gc_interval=BLOB_GC_INTERVAL,
+    grace=BLOB_GC_GRACE
+)
+state.SharedState.blob_store.adopt_legacy_files()
+state.SharedState.pdf_cache = PdfCache(
+    state.SharedState.conn,
+    state.SharedState.PDF_STORAGE_PATH,
+    state.SharedState.blob_store,
+    PDF_CACHE_MAX_BYTES
+)
+state.SharedState.pdf_cache.sync()
+state.SharedState.query_cache = QueryCache(
+    max_entries=QUERY_CACHE_SIZE,
+    ttl=QUERY_CACHE_TTL,
+    quantum=QUERY_CACHE_QUANTUM,
+    similarity=QUERY_CACHE_SIMILARITY
+)
 
 # CORS configuration
 origins = ["*"]
@@ -47,18 +128,64 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency per route template, so ids in paths do not create new series
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status)
+        ).observe(time.perf_counter() - started)
+
+PENDING_KEY_REQUESTS.set_function(
+    lambda: state.SharedState.key_broker.pending_chunk_count() if state.SharedState.key_broker else 0
+)
+
 # Include routers
 app.include_router(document_router, prefix="", tags=["documents"])
 app.include_router(chunk_router, prefix="", tags=["chunks"])
 app.include_router(rating_router, prefix="", tags=["ratings"])
 app.include_router(query_router, prefix="", tags=["query"])
 
+# Threadpool size, pooled async HTTP client and key request broker, bound to the event loop at startup
+@app.on_event("startup")
+async def startup():
+    # Database-bound handlers are plain functions run in this pool, one DuckDB cursor each
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    state.SharedState.http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+    state.SharedState.key_broker = KeyRequestBroker(
+        window_seconds=state.SharedState.KEY_REQUEST_BATCH_WINDOW_MS / 1000,
+        max_batch_size=state.SharedState.KEY_REQUEST_MAX_BATCH,
+        publication_timeout=KEY_PUBLICATION_TIMEOUT,
+        publication_poll_interval=KEY_PUBLICATION_POLL_INTERVAL
+    )
+    state.SharedState.outbox.start()
+    state.SharedState.blob_store.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    state.SharedState.blob_store.stop()
+    state.SharedState.outbox.stop()
+    shutdown_decrypt_pool()
+    await state.SharedState.http_client.aclose()
+    state.SharedState.gateway.close()
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Base route for health check
 @app.get("/")
 async def health_check():
-    return {"status": "healthy", "message": "RAG Server is running"}
-
-if __name__ == "__main__":
-    import uvicorn
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("rag_server:app", host="0.0.0.0", port=port, workers=1)
\ No newline at end of file
+    return {"status": "healthy", "message": "RAG Server is running"}
\ No newline at end of file
@@ -1,16 +1,29 @@
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from models import BuyChunksRequest
 from utils.auth import verify_rag_server_secret
-from state import SharedState
+from utils.db import get_cursor, transaction, add_chunk_rewards
 
 router = APIRouter()
 
 @router.get("/get_chunk")
-async def get_chunk(chunkId: str, ragServerSecret: str):
+def get_chunk(chunkId: str, ragServerSecret: str, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(ragServerSecret)
         
-        chunk = SharedState.conn.execute("SELECT * FROM chunks WHERE chunk_id = ?", [chunkId]).fetchone()
+        # Encrypted chunks are returned as base64 ciphertext, like they were uploaded
+        chunk = cur.execute("""
+            SELECT
+                chunk_id,
+                document_id,
+                CASE WHEN encrypted THEN to_base64(ciphertext) ELSE content END,
+                encrypted,
+                reward,
+                public_key,
+                key_server_public_key
+            FROM chunks
+            WHERE chunk_id = ?
+        """, [chunkId]).fetchone()
         if not chunk:
             raise HTTPException(status_code=404, detail="Chunk not found")
         return {
@@ -26,18 +39,65 @@ async def get_chunk(chunkId: str, ragServerSecret: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/buy-chunks")
-async def buy_chunks(request: BuyChunksRequest):
+def buy_chunks(request: BuyChunksRequest, cur=Depends(get_cursor)):
     verify_rag_server_secret(request.ragServerSecret)
+    if len(request.chunkIds) != len(request.prices):
+        raise HTTPException(status_code=400, detail="chunkIds and prices must have the same length")
     
     try:
-        for i, chunk_id in enumerate(request.chunkIds):
-            SharedState.conn.execute("""
-                UPDATE chunks
-                SET reward = reward + ?
-                WHERE chunk_id = ?
-            """, (request.prices[i], chunk_id))
+        with transaction(cur):
+            add_chunk_rewards(cur, request.chunkIds, request.prices)
 
         return {"message": "Successfully bought chunks"}
     except Exception as e:
         print(f"Error processing buy chunks: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+OWNED_CHUNK_IDS_MAX_LIMIT = 10000
+
+@router.get("/owned-chunk-ids")
+def get_owned_chunk_ids(
+    ragServerSecret: str,
+    publicKey: str,
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = 1000,
+    cur=Depends(get_cursor)
+):
+    """Page through the ids of all chunks uploaded by `publicKey`, ordered by chunk id.
+
+    Pass the returned `next_cursor` as `after` to get the next page. The ETag
+    changes whenever a document of the owner is uploaded or deleted.
+    """
+    verify_rag_server_secret(ragServerSecret)
+    if not 0 < limit <= OWNED_CHUNK_IDS_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {OWNED_CHUNK_IDS_MAX_LIMIT}")
+
+    try:
+        # The owned set only changes with uploads and deletes, which rewrite document_stats
+        version = cur.execute("""
+            SELECT md5(COALESCE(string_agg(document_id || ':' || total_chunks, ',' ORDER BY document_id), ''))
+            FROM document_stats
+            WHERE public_key = ?
+        """, [publicKey]).fetchone()[0]
+        etag = f'"{version}-{after or ""}-{limit}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        rows = cur.execute("""
+            SELECT chunk_id
+            FROM chunks
+            WHERE public_key = ? AND (? IS NULL OR chunk_id > ?)
+            ORDER BY chunk_id
+            LIMIT ?
+        """, (publicKey, after, after, limit)).fetchall()
+        chunk_ids = [row[0] for row in rows]
+
+        response.headers["ETag"] = etag
+        return {
+            "chunk_ids": chunk_ids,
+            "next_cursor": chunk_ids[-1] if len(chunk_ids) == limit else None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,90 +1,171 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
 from models import DocumentUpload, DeleteDocumentRequest
 import os
 import base64
-import requests
-from utils.helpers import decrypt_pdf_file, decrypt
-from utils.hedera_interactions import request_chunk_keys, rateKeyOwners
+from utils.helpers import decrypt_chunks
+from utils.document_keys import open_document_keys, fetch_chunk_keys
+from utils.hedera_interactions import request_chunk_keys
 from utils.auth import verify_rag_server_secret
+from utils.db import get_cursor, transaction, insert_chunks, store_decrypted_chunks, add_embeddings
+from utils.document_stats import refresh_document_stats, delete_document_stats, record_document_reward
+from utils.embeddings import chunk_embeddings
+from utils.metrics import timed
 from state import SharedState
 
 router = APIRouter()
 
 @router.post("/upload")
-async def upload_document(document: DocumentUpload):
+def upload_document(document: DocumentUpload, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(document.ragServerSecret)
+        if not document.chunks:
+            raise HTTPException(status_code=400, detail="Upload contains no chunks")
 
         ids = [chunk.id for chunk in document.chunks]
-        embeddings = [chunk.embedding for chunk in document.chunks]
+        embeddings = chunk_embeddings(document)
+        # Ciphertext is stored as bytes, decoded once here instead of on every decryption
+        ciphertexts = [base64.b64decode(chunk.encrypted_content, validate=True) for chunk in document.chunks]
 
-        if SharedState.conn.execute("SELECT * FROM documents WHERE document_name = ?", [document.documentTitle]).fetchone():
+        if cur.execute("SELECT * FROM documents WHERE document_name = ?", [document.documentTitle]).fetchone():
             raise HTTPException(status_code=409, detail="Document with that name already exists")
-        
-        SharedState.collection.add(
-            ids=ids,
-            embeddings=embeddings,
-        )
-
-        pdf_path = os.path.join(SharedState.PDF_STORAGE_PATH, f"{document.documentId}.raw")
-        with open(pdf_path, "wb") as f:
-            encrypted_bytes = base64.b64decode(document.encryptedDocument)
-            f.write(encrypted_bytes)
-        
-        for chunk in document.chunks:
-            SharedState.conn.execute("""
-                INSERT OR REPLACE INTO chunks 
-                (chunk_id, document_id, content, encrypted, reward, public_key, key_server_public_key)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                chunk.id, 
-                document.documentId, 
-                chunk.encrypted_content, 
-                True, 
-                0.0, 
+
+        # Stored before the transaction, if it fails the unreferenced blob is garbage collected
+        blob_hash = None
+        staged = False
+        if document.encryptedDocument is not None:
+            blob_hash, _ = SharedState.blob_store.put_bytes(base64.b64decode(document.encryptedDocument))
+        else:
+            staged = SharedState.blob_store.staged_blob(cur, document.documentId) is not None
+            if not staged and not SharedState.blob_store.has_document(cur, document.documentId):
+                raise HTTPException(status_code=400, detail="Encrypted document has not been uploaded")
+
+        # Metadata and the blob link are committed first, so the vector inserts below do not hold the write lock
+        with transaction(cur):
+            if staged:
+                # The staged blob may have been garbage collected since the check above
+                blob_hash = SharedState.blob_store.staged_blob(cur, document.documentId)
+                if blob_hash is None:
+                    raise HTTPException(status_code=410, detail="Document blob expired, upload it again")
+
+            insert_chunks(
+                cur,
+                ids,
+                ciphertexts,
+                document.documentId,
                 document.publicKey,
                 document.keyServerPublicKey
-            ))
-        SharedState.conn.execute("""
-                INSERT OR REPLACE INTO documents 
-                (document_id, document_name, encrypted)
-                VALUES (?, ?, ?)
-            """, (
-                document.documentId,
-                document.documentTitle,
-                True
-            ))
+            )
+            cur.execute("""
+                    INSERT OR REPLACE INTO documents 
+                    (document_id, document_name, encrypted)
+                    VALUES (?, ?, ?)
+                """, (
+                    document.documentId,
+                    document.documentTitle,
+                    True
+                ))
+            refresh_document_stats(cur, [document.documentId])
+
+            if blob_hash is not None:
+                SharedState.blob_store.attach(cur, document.documentId, blob_hash)
+
+        try:
+            # Removes the vectors it already added if a batch fails
+            with timed("add_embeddings"):
+                add_embeddings(SharedState.vector_index, ids, embeddings, SharedState.VECTOR_ADD_BATCH_SIZE)
+        except Exception:
+            _undo_upload(cur, document.documentId, ids, blob_hash if staged else None)
+            raise
+        finally:
+            SharedState.query_cache.bump_version()
             
         return {"message": f"Successfully uploaded {len(document.chunks)} chunks"}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error processing upload: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _undo_upload(cur, document_id, chunk_ids, staged_hash):
+    """Remove the committed rows of an upload whose vectors could not be added."""
+    with transaction(cur):
+        cur.execute("DELETE FROM chunks WHERE chunk_id IN (SELECT UNNEST(?::VARCHAR[]))", [chunk_ids])
+        cur.execute("DELETE FROM documents WHERE document_id = ?", [document_id])
+        delete_document_stats(cur, document_id)
+        SharedState.blob_store.detach(cur, document_id)
+    if staged_hash is not None:
+        # Lets the client retry /upload without streaming the blob again
+        SharedState.blob_store.stage(document_id, staged_hash)
+
+def _document_exists(document_id):
+    cursor = SharedState.conn.cursor()
+    try:
+        if cursor.execute("SELECT 1 FROM documents WHERE document_id = ?", [document_id]).fetchone():
+            return True
+        return SharedState.blob_store.has_document(cursor, document_id)
+    finally:
+        cursor.close()
+
+@router.post("/upload_document_blob")
+async def upload_document_blob(request: Request, documentId: str, ragServerSecret: str, encoding: str = "binary"):
+    """Stream the encrypted document to the blob store without holding it in memory.
+
+    The body is either the raw ciphertext (`encoding=binary`) or its base64 form
+    (`encoding=base64`), which is decoded piece by piece as it arrives. Identical
+    ciphertext is stored only once. The blob stays staged until a later /upload
+    call without `encryptedDocument` links it to the document, and is garbage
+    collected if that call does not arrive within the grace period.
+    """
+    try:
+        verify_rag_server_secret(ragServerSecret)
+
+        if encoding not in ("binary", "base64"):
+            raise HTTPException(status_code=400, detail="Unsupported encoding")
+        if not documentId or os.path.basename(documentId) != documentId:
+            raise HTTPException(status_code=400, detail="Invalid document id")
+        if await run_in_threadpool(_document_exists, documentId):
+            raise HTTPException(status_code=409, detail="Document already exists")
+
+        blob_hash, size = await SharedState.blob_store.put_stream(request.stream(), decode_base64=encoding == "base64")
+        await run_in_threadpool(SharedState.blob_store.stage, documentId, blob_hash)
+
+        return {"message": "Successfully stored document blob", "document_id": documentId, "size": size, "sha256": blob_hash}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error processing document blob upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/get_document_pdf")
 async def get_document_pdf(documentId: str, ragServerSecret: str):
     try:
         verify_rag_server_secret(ragServerSecret)
         
-        pdf_path = os.path.join(SharedState.PDF_STORAGE_PATH, f"{documentId}.pdf")
-        if not os.path.exists(pdf_path):
+        # Decrypts the PDF again if it was evicted from the cache
+        pdf_path = await run_in_threadpool(SharedState.pdf_cache.get, documentId)
+        if pdf_path is None:
             raise HTTPException(status_code=404, detail="PDF file not found")
         
-        return FileResponse(pdf_path)
+        # Serves single and multi-part byte ranges (206) as well as full downloads
+        return FileResponse(pdf_path, media_type="application/pdf")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/get_document_price")
-async def get_document_price(documentId: str, ragServerSecret: str):
+def get_document_price(documentId: str, ragServerSecret: str, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(ragServerSecret)
         
-        chunk_count = SharedState.conn.execute(
+        chunk_count = cur.execute(
             "SELECT COUNT(*) FROM chunks WHERE document_id = ?", 
             [documentId]
         ).fetchone()[0]
 
-        document_name = SharedState.conn.execute(
+        document_name = cur.execute(
             "SELECT document_name FROM documents WHERE document_id = ?", 
             [documentId]
         ).fetchone()[0]
@@ -104,42 +185,22 @@ async def get_document_price(documentId: str, ragServerSecret: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/get_documents")
-async def get_documents(ragServerSecret: str, publicKey: str):
+def get_documents(ragServerSecret: str, publicKey: str, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(ragServerSecret)
-        result = SharedState.conn.execute("""
-            WITH document_stats AS (
-                SELECT
-                    c.document_id,
-                    COUNT(*) as total_chunks,
-                    SUM(CASE WHEN c.encrypted THEN 1 ELSE 0 END) as encrypted_chunks,
-                    SUM(c.reward) as total_reward
-                FROM chunks c
-                WHERE c.public_key = ?
-                GROUP BY c.document_id
-            ),
-            document_ratings AS (
-                SELECT
-                    c.document_id,
-                    COALESCE(SUM(CASE WHEN r.rating > 0 THEN 1 ELSE 0 END), 0) as upvotes,
-                    COALESCE(SUM(CASE WHEN r.rating < 0 THEN 1 ELSE 0 END), 0) as downvotes,
-                    COALESCE(SUM(r.rating), 0) as total_rating
-                FROM chunks c
-                LEFT JOIN ratings r ON c.chunk_id = r.chunk_id
-                GROUP BY c.document_id
-            )
+        result = cur.execute("""
             SELECT
                 d.document_id,
                 d.document_name,
                 ds.total_chunks,
                 ds.encrypted_chunks,
                 ds.total_reward,
-                COALESCE(dr.total_rating, 0) as rating,
-                COALESCE(dr.upvotes, 0) as upvotes,
-                COALESCE(dr.downvotes, 0) as downvotes
-            FROM documents d
-            JOIN document_stats ds ON d.document_id = ds.document_id
-            LEFT JOIN document_ratings dr ON d.document_id = dr.document_id
+                ds.total_rating,
+                ds.upvotes,
+                ds.downvotes
+            FROM document_stats ds
+            JOIN documents d ON d.document_id = ds.document_id
+            WHERE ds.public_key = ?
         """, [publicKey]).fetchall()
 
         documents = [
@@ -159,11 +220,11 @@ async def get_documents(ragServerSecret: str, publicKey: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/delete_document")
-async def delete_document(request: DeleteDocumentRequest):
+def delete_document(request: DeleteDocumentRequest, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(request.ragServerSecret)
             
-        doc_result = SharedState.conn.execute("""
+        doc_result = cur.execute("""
             SELECT document_id
             FROM documents 
             WHERE document_name = ?
@@ -173,12 +234,9 @@ async def delete_document(request: DeleteDocumentRequest):
             raise HTTPException(status_code=404, detail="Document not found")
             
         document_id = doc_result[0]
-        pdf_path = os.path.join(SharedState.PDF_STORAGE_PATH, f"{document_id}.raw")
-        
-        if pdf_path and os.path.exists(pdf_path):
-            os.remove(pdf_path)
+        SharedState.pdf_cache.discard(document_id)
         
-        chunk_ids = SharedState.conn.execute("""
+        chunk_ids = cur.execute("""
             SELECT chunk_id
             FROM chunks
             WHERE public_key = ? AND document_id = ?
@@ -187,33 +245,39 @@ async def delete_document(request: DeleteDocumentRequest):
         chunk_ids = [row[0] for row in chunk_ids]
         
         if chunk_ids:
-            SharedState.collection.delete(ids=chunk_ids)
+            SharedState.vector_index.delete(chunk_ids)
+            SharedState.query_cache.bump_version()
         
-        SharedState.conn.execute("""
-            DELETE FROM chunks
-            WHERE document_id = ?
-        """, [document_id])
-        
-        SharedState.conn.execute("""
-            DELETE FROM documents
-            WHERE document_id = ?
-        """, [document_id])
+        with transaction(cur):
+            cur.execute("""
+                DELETE FROM chunks
+                WHERE document_id = ?
+            """, [document_id])
+            
+            cur.execute("""
+                DELETE FROM documents
+                WHERE document_id = ?
+            """, [document_id])
+
+            delete_document_stats(cur, document_id)
+            # The blob itself is removed by garbage collection once no document uses it
+            SharedState.blob_store.detach(cur, document_id)
         
         return {"message": f"Successfully deleted document: {request.documentName}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/buy-document")
-async def buy_document(ragServerSecret: str, documentId: str):
+def buy_document(ragServerSecret: str, documentId: str, cur=Depends(get_cursor)):
     verify_rag_server_secret(ragServerSecret)
     
     try:
-        chunk_count = SharedState.conn.execute(
+        chunk_count = cur.execute(
             "SELECT COUNT(*) FROM chunks WHERE document_id = ?", 
             [documentId]
         ).fetchone()[0]
 
-        document_name = SharedState.conn.execute(
+        document_name = cur.execute(
             "SELECT document_name FROM documents WHERE document_id = ?", 
             [documentId]
         ).fetchone()[0]
@@ -221,55 +285,64 @@ async def buy_document(ragServerSecret: str, documentId: str):
         if chunk_count == 0:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        document_encrypted = SharedState.conn.execute("SELECT encrypted FROM documents WHERE document_id = ?", [documentId]).fetchone()[0]
-        if document_encrypted:
-            secret_key = requests.post(f"{SharedState.KEY_SERVER_API}/get-keys-for-document", json={"key_server_secret": SharedState.KEY_SERVER_SECRET, "document_id": documentId}).json()
-            with open(os.path.join("documents", f"{documentId}.raw"), "rb") as encrypted_file:
-                encrypted_data = encrypted_file.read()
-
-            decrypted_data = decrypt_pdf_file(encrypted_data, secret_key)
-
-            with open(os.path.join("documents", f"{documentId}.pdf"), "wb") as decrypted_file:
-                decrypted_file.write(decrypted_data)
-            print(f"Successfully bought document: {documentId}")
+        document_encrypted = cur.execute("SELECT encrypted FROM documents WHERE document_id = ?", [documentId]).fetchone()[0]
             
         price = chunk_count * 2
         chunk_price = price / chunk_count
 
-        chunks = SharedState.conn.execute("""
-            SELECT chunk_id, content, public_key
+        chunks = cur.execute("""
+            SELECT chunk_id, ciphertext, public_key
             FROM chunks
             WHERE document_id = ? AND encrypted = TRUE
         """, [documentId]).fetchall()
+        ciphertext_by_chunk = {row[0]: row[1] for row in chunks}
 
-        encrypted_chunk_ids = [row[0] for row in chunks]
+        decrypted = {}
+        failures = {}
+        def decrypt_keyed(keys):
+            triples = [
+                (key["chunk_id"], ciphertext_by_chunk[key["chunk_id"]], key["secret_key"])
+                for key in keys if key["chunk_id"] in ciphertext_by_chunk
+            ]
+            with timed("decrypt"):
+                batch_decrypted, batch_failures = decrypt_chunks(triples)
+            decrypted.update(batch_decrypted)
+            failures.update(batch_failures)
 
-        if encrypted_chunk_ids:
-            response = requests.post(f"{SharedState.KEY_SERVER_API}/get-keys/", json={"chunk_ids": encrypted_chunk_ids, "whole_document": True})
+        if document_encrypted or chunks:
+            # One key-server round trip for the document key and all chunk keys,
+            # every batch is decrypted as soon as it has arrived
+            with timed("key_server_fetch"):
+                secret_key, key_batches = open_document_keys(documentId)
+            for keys in key_batches:
+                decrypt_keyed(keys)
 
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-            
-            keys = response.json()
-        else:
-            keys = []
-        
-        for chunk in chunks:
-            chunk_id = chunk[0]
-            secret_key = [key["secret_key"] for key in keys if key["chunk_id"] == chunk_id][0]
-            decrypted_content = decrypt(chunk[1], secret_key)
+            # Keys uploaded before the key-server linked chunk keys to their document
+            missing = [chunk_id for chunk_id in ciphertext_by_chunk if chunk_id not in decrypted and chunk_id not in failures]
+            if missing:
+                with timed("key_server_fetch"):
+                    keys = fetch_chunk_keys(missing)
+                decrypt_keyed(keys)
+                for chunk_id in missing:
+                    if chunk_id not in decrypted and chunk_id not in failures:
+                        failures[chunk_id] = "No key returned for chunk"
 
-            SharedState.conn.execute("""
-                UPDATE chunks
-                SET content = ?, encrypted = FALSE
-                WHERE chunk_id = ?
-            """, (decrypted_content, chunk_id))
+        if failures:
+            raise HTTPException(status_code=500, detail={"message": "Failed to decrypt chunks", "failures": failures})
 
-        SharedState.conn.execute("""
-            UPDATE chunks
-                SET reward = reward + ?
-                WHERE document_id = ?
-            """, (chunk_price, documentId))
+        if document_encrypted:
+            SharedState.pdf_cache.store(documentId, secret_key)
+            print(f"Successfully bought document: {documentId}")
+
+        with transaction(cur):
+            store_decrypted_chunks(cur, list(decrypted.keys()), list(decrypted.values()))
+
+            cur.execute("""
+                UPDATE chunks
+                    SET reward = reward + ?
+                    WHERE document_id = ?
+                """, (chunk_price, documentId))
+            record_document_reward(cur, documentId, chunk_price)
         
         return {
             "document_id": documentId,
@@ -1,124 +1,266 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from models import QueryRequest
-import requests
-from utils.helpers import decrypt
-from utils.hedera_interactions import request_chunk_keys, rateKeyOwners
+import asyncio
+import base64
+import bisect
+import json
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from models import QueryRequest, BatchQueryRequest
+from utils.helpers import decrypt_chunks, index_keys
+from utils.hedera_interactions import rateKeyOwners
+from utils.db import transaction, store_decrypted_chunks
+from utils.embeddings import query_embedding, query_embeddings
+from utils.metrics import timed
 from state import SharedState
 
 router = APIRouter()
 
+CONTENT_MODES = ("full", "preview", "ids")
+PREVIEW_LENGTH = 100
+
+def _search(query_embeddings, n_results):
+    """Vector search through the query cache, only uncached embeddings reach the index."""
+    cache = SharedState.query_cache
+    # Read before searching, results of a search that overlaps an upload or delete are not cached
+    version = cache.version
+    ids = [None] * len(query_embeddings)
+    distances = [None] * len(query_embeddings)
+    misses = []
+    for i, embedding in enumerate(query_embeddings):
+        cached = cache.get(embedding, n_results)
+        if cached is None:
+            misses.append(i)
+        else:
+            ids[i], distances[i] = cached
+
+    if misses:
+        with timed("vector_search"):
+            results = SharedState.vector_index.query([query_embeddings[i] for i in misses], n_results)
+        for i, hit_ids, hit_distances in zip(misses, results["ids"], results["distances"]):
+            ids[i], distances[i] = hit_ids, hit_distances
+            cache.put(query_embeddings[i], n_results, hit_ids, hit_distances, version)
+    return {"ids": ids, "distances": distances}
+
+def _load_chunks(chunk_ids, with_content=True):
+    # Each worker thread gets its own cursor, the shared connection is not safe to use concurrently
+    cursor = SharedState.conn.cursor()
+    # Without content the rows keep their shape, with NULL content and ciphertext
+    content_columns = ("c.content", "c.ciphertext") if with_content else ("NULL", "NULL")
+    try:
+        with timed("load_chunks"):
+            return cursor.execute(f"""
+                    SELECT
+                        c.chunk_id,
+                        c.document_id,
+                        d.document_name,
+                        {content_columns[0]},
+                        c.encrypted,
+                        c.reward,
+                        c.public_key,
+                        c.key_server_public_key,
+                        {content_columns[1]}
+                    FROM
+                        chunks c
+                    JOIN
+                        documents d
+                    ON
+                        c.document_id = d.document_id
+                    WHERE
+                        c.chunk_id IN (SELECT * FROM UNNEST(?))
+            """, [chunk_ids]).fetchall()
+    finally:
+        cursor.close()
+
+def _store_decrypted(decrypted):
+    cursor = SharedState.conn.cursor()
+    try:
+        with timed("store_decrypted"), transaction(cursor):
+            store_decrypted_chunks(cursor, list(decrypted.keys()), list(decrypted.values()))
+    finally:
+        cursor.close()
+
+def _owned_chunk_ids(chunks, public_key):
+    """Ids of the result chunks uploaded by `public_key`, the full owned set is served by /owned-chunk-ids."""
+    return list(dict.fromkeys(chunk["chunk_id"] for chunk in chunks if chunk["public_key"] == public_key))
+
+async def _unlock_chunks(rows, distances):
+    """Buy keys for the encrypted rows, decrypt them and persist the plaintext.
+
+    `distances` maps chunk ids to their best distance, which sets the price.
+    Returns {chunk_id: plaintext} for every chunk that could be decrypted.
+    """
+    encrypted_rows = [chunk for chunk in rows if chunk[4]]
+    if not encrypted_rows:
+        return {}
+
+    # Group by key server so every group becomes one (brokered) on-chain request
+    groups = {}
+    for chunk in encrypted_rows:
+        groups.setdefault(chunk[7], []).append(chunk[0])
+
+    print("Encrypted chunk ids:", [chunk[0] for chunk in encrypted_rows])
+
+    # Includes the broker's batching window, the on-chain request and the key-server call
+    with timed("acquire_keys"):
+        key_responses = await asyncio.gather(*(
+            SharedState.key_broker.request_keys(
+                chunk_ids,
+                [round(float(SharedState.MAX_CHUNK_PRICE) / (distances[chunk_id] + 1)) for chunk_id in chunk_ids],
+                key_server_public_key
+            )
+            for key_server_public_key, chunk_ids in groups.items()
+        ))
+    keys_by_chunk = {}
+    for keys in key_responses:
+        keys_by_chunk.update(index_keys(keys))
+
+    with timed("decrypt"):
+        decrypted, failures = await run_in_threadpool(decrypt_chunks, [
+            (chunk[0], chunk[8], keys_by_chunk.get(chunk[0])) for chunk in encrypted_rows
+        ])
+    for chunk_id, error in failures.items():
+        print(f"Error decrypting chunk {chunk_id}: {error}")
+
+    # Update the database with decrypted content and set encrypted to False
+    if decrypted:
+        await run_in_threadpool(_store_decrypted, decrypted)
+
+    key_owners = [chunk[6] for chunk in encrypted_rows]
+    ratings = [chunk[0] in decrypted for chunk in encrypted_rows]
+    # Persisted in the outbox before responding, the chain transaction is sent later
+    await run_in_threadpool(rateKeyOwners, key_owners, ratings)
+
+    return decrypted
+
+def _rank(ids, distances):
+    """(distance, chunk_id) pairs of one query, sorted once. Chunk ids break distance ties."""
+    return sorted(zip(distances, ids))
+
+def _encode_cursor(hit):
+    return base64.urlsafe_b64encode(json.dumps(list(hit)).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        distance, chunk_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(distance), str(chunk_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _page(ranked, cursor, page_size):
+    """Hits after `cursor`, at most `page_size` of them, and the cursor of the next page.
+
+    The cursor is the last (distance, chunk_id) returned, so pages stay consistent
+    while chunks are added or removed.
+    """
+    start = bisect.bisect_right(ranked, _decode_cursor(cursor)) if cursor else 0
+    page = ranked[start:start + page_size]
+    next_cursor = _encode_cursor(page[-1]) if start + page_size < len(ranked) else None
+    return page, next_cursor
+
+def _assemble_chunks(ranked, rows_by_chunk, decrypted, content_mode="full"):
+    """Result dicts in the order of `ranked`, one dict lookup per chunk."""
+    chunks = []
+    for distance, chunk_id in ranked:
+        chunk = rows_by_chunk.get(chunk_id)
+        if chunk is None:
+            continue
+        result = {
+            "chunk_id": chunk_id,
+            "document_id": chunk[1],
+            "document_name": chunk[2],
+            "encrypted": chunk[4],
+            "reward": chunk[5],
+            "public_key": chunk[6],
+            "key_server_public_key": chunk[7],
+            "distance": distance
+        }
+        if content_mode != "ids":
+            # Chunks that failed to decrypt are returned as base64 ciphertext, like they were uploaded
+            content = decrypted.get(chunk_id)
+            if content is None:
+                content = base64.b64encode(chunk[8] or b"").decode() if chunk[4] else chunk[3]
+            if content_mode == "full":
+                result["content"] = content
+            result["content_preview"] = content[:PREVIEW_LENGTH]
+        chunks.append(result)
+    return chunks
+
+async def _fetch_chunks(per_query_hits, content_mode="full"):
+    """Load and, unless only ids are wanted, unlock the union of the hits of all queries.
+
+    Returns one list of result chunks per query.
+    """
+    # Best distance per chunk over all queries
+    best_distances = {}
+    for hits in per_query_hits:
+        for distance, chunk_id in hits:
+            best_distances[chunk_id] = min(distance, best_distances.get(chunk_id, distance))
+
+    rows = await run_in_threadpool(_load_chunks, list(best_distances), content_mode != "ids")
+    rows_by_chunk = {chunk[0]: chunk for chunk in rows}
+
+    decrypted = {} if content_mode == "ids" else await _unlock_chunks(rows, best_distances)
+
+    return [_assemble_chunks(hits, rows_by_chunk, decrypted, content_mode) for hits in per_query_hits]
+
+def _check_n_results(n_results, name="n_results"):
+    if not 0 < n_results <= SharedState.MAX_QUERY_RESULTS:
+        raise HTTPException(status_code=400, detail=f"{name} must be between 1 and {SharedState.MAX_QUERY_RESULTS}")
+
 @router.post("/query")
-async def query_document(request: QueryRequest, background_tasks: BackgroundTasks):
+async def query_document(request: QueryRequest):
     try:
         if request.ragServerSecret != SharedState.RAG_SERVER_SECRET:
             raise HTTPException(status_code=401, detail="RAG Authentication failed")
-        
-        results = SharedState.collection.query(
-            query_embeddings=[request.query_embedding],
-            n_results=request.n_results,
-            include=["metadatas", "distances"]
-        )
 
-        chunk_ids = results['ids'][0]
-
-        duckdb_results = SharedState.conn.execute("""
-                SELECT 
-                    c.chunk_id, 
-                    c.document_id, 
-                    d.document_name,
-                    c.content, 
-                    c.encrypted, 
-                    c.reward, 
-                    c.public_key, 
-                    c.key_server_public_key
-                FROM 
-                    chunks c
-                JOIN 
-                    documents d 
-                ON 
-                    c.document_id = d.document_id
-                WHERE 
-                    c.chunk_id IN (SELECT * FROM UNNEST(?))
-            """, [chunk_ids]).fetchall()
+        _check_n_results(request.n_results)
+        page_size = request.page_size or request.n_results
+        _check_n_results(page_size, "page_size")
+        if request.content not in CONTENT_MODES:
+            raise HTTPException(status_code=400, detail=f"content must be one of {', '.join(CONTENT_MODES)}")
 
-        encrypted_chunk_ids = [chunk[0] for chunk in duckdb_results if chunk[4]]
+        results = await run_in_threadpool(_search, [query_embedding(request)], request.n_results)
+        # Only the chunks of the requested page are loaded, bought and decrypted
+        page, next_cursor = _page(
+            _rank(results["ids"][0], results["distances"][0]), request.cursor, page_size
+        )
+        decrypted_chunks = (await _fetch_chunks([page], request.content))[0]
 
-        print("Encrypted chunk ids:", encrypted_chunk_ids)
-        print("Key server public key:", duckdb_results[0][7])
-        
-        distances = [results["distances"][0][i] for i, id in enumerate(results["ids"][0]) if id in encrypted_chunk_ids]
-        prices = [round(float(SharedState.MAX_CHUNK_PRICE) / (distances[i] + 1)) for i in range(len(distances))]
+        return {
+            "chunks": decrypted_chunks,
+            "chunk_ids_owned": _owned_chunk_ids(decrypted_chunks, request.publicKey),
+            "next_cursor": next_cursor
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error processing query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        print("Prices:", prices)
+@router.post("/query/batch")
+async def query_documents_batch(request: BatchQueryRequest):
+    try:
+        if request.ragServerSecret != SharedState.RAG_SERVER_SECRET:
+            raise HTTPException(status_code=401, detail="RAG Authentication failed")
 
-        if encrypted_chunk_ids:
-            await request_chunk_keys(encrypted_chunk_ids, prices, duckdb_results[0][7])
+        _check_n_results(request.n_results)
+        embeddings = query_embeddings(request)
+        if len(embeddings) == 0:
+            return {"results": [], "chunk_ids_owned": []}
 
-            response = requests.post(f"{SharedState.KEY_SERVER_API}/get-keys/", 
-                                  json={"chunk_ids": encrypted_chunk_ids, "whole_document": False})
+        # All embeddings are searched at once and the union of their chunks is unlocked once
+        results = await run_in_threadpool(_search, embeddings, request.n_results)
+        per_query_chunks = await _fetch_chunks([
+            _rank(ids, distances) for ids, distances in zip(results["ids"], results["distances"])
+        ])
 
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-            
-            keys = response.json()
-        else:
-            keys = []
-
-        key_owners = []
-        ratings = []
-        decrypted_chunks = []
-        for chunk in duckdb_results:
-            chunk_id = chunk[0]
-            if chunk[4]:  # Check if the chunk is encrypted
-                secret_key = [key["secret_key"] for key in keys if key["chunk_id"] == chunk_id][0]
-                try:
-                    decrypted_content = decrypt(chunk[3], secret_key)
-                    key_owners.append(chunk[6])
-                    ratings.append(True)
-                except Exception as e:
-                    print(f"Error decrypting chunk {chunk_id}: {str(e)}")
-                    key_owners.append(chunk[6])
-                    ratings.append(False)
-
-                # Update the database with decrypted content and set encrypted to False
-                SharedState.conn.execute("""
-                    UPDATE chunks
-                    SET content = ?, encrypted = FALSE
-                    WHERE chunk_id = ?
-                """, (decrypted_content, chunk_id))
-            else:
-                decrypted_content = chunk[3]  # No decryption needed for unencrypted content
-
-            distance = [results["distances"][0][i] for i, id in enumerate(results["ids"][0]) if id == chunk_id][0]
-            decrypted_chunks.append({
-                "chunk_id": chunk_id,
-                "document_id": chunk[1],
-                "document_name": chunk[2],
-                "content": decrypted_content,
-                "content_preview": decrypted_content[:100],
-                "encrypted": chunk[4],
-                "reward": chunk[5],
-                "public_key": chunk[6],
-                "key_server_public_key": chunk[7],
-                "distance": distance
-            })
-
-        decrypted_chunks.sort(key=lambda x: x["distance"])
-
-        chunk_ids_owned = SharedState.conn.execute("""
-            SELECT chunk_id
-            FROM chunks
-            WHERE public_key = ?
-        """, [request.publicKey]).fetchall()
-
-        chunk_ids_owned = [row[0] for row in chunk_ids_owned]
-
-        print("Chunk ids owned:", chunk_ids_owned, "Decrypted chunks:", decrypted_chunks)
-
-        if encrypted_chunk_ids:
-            background_tasks.add_task(rateKeyOwners, key_owners, ratings)
-
-        return {"chunks": decrypted_chunks, "chunk_ids_owned": chunk_ids_owned}
+        return {
+            "results": [{"chunks": chunks} for chunks in per_query_chunks],
+            "chunk_ids_owned": _owned_chunk_ids(
+                [chunk for chunks in per_query_chunks for chunk in chunks], request.publicKey
+            )
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error processing query: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        print(f"Error processing batch query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
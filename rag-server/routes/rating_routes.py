@@ -1,58 +1,52 @@
-from fastapi import APIRouter, HTTPException
-from models import ChunkRating, ChunkRatingsRequest
-import time
+from fastapi import APIRouter, HTTPException, Depends
+from models import ChunkRating, ChunkRatingsRequest, ChunkRatingsBatch
 from utils.auth import verify_rag_server_secret
-from state import SharedState
+from utils.db import get_cursor, transaction, upsert_ratings
 
 router = APIRouter()
 
 @router.post("/rate-chunk-id")
-async def rate_chunk_id(request: ChunkRating):
+def rate_chunk_id(request: ChunkRating, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(request.ragServerSecret)
         
-        #If user with public key has already rated chunk, update the rating otherwise insert
-        if SharedState.conn.execute("SELECT * FROM ratings WHERE chunk_id = ? AND public_key = ?", [request.chunkId, request.publicKey]).fetchone():
-            SharedState.conn.execute("""
-                UPDATE ratings
-                SET rating = ?
-                WHERE chunk_id = ? AND public_key = ?
-            """, (request.rating, request.chunkId, request.publicKey))
-        else:
-            SharedState.conn.execute("""
-                INSERT INTO ratings
-                (rating_id, public_key, chunk_id, rating)
-                VALUES (?, ?, ?, ?)
-            """, (str(time.time()), request.publicKey, request.chunkId, request.rating))
+        with transaction(cur):
+            upsert_ratings(cur, request.publicKey, {request.chunkId: request.rating})
 
+        return {"message": "Successfully rated chunk"}
 
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return {"message": "Successfully rated chunk"}
+@router.post("/rate-chunk-ids")
+def rate_chunk_ids(request: ChunkRatingsBatch, cur=Depends(get_cursor)):
+    try:
+        verify_rag_server_secret(request.ragServerSecret)
+
+        # A chunk rated twice in one batch keeps its last rating
+        ratings = {item.chunkId: item.rating for item in request.ratings}
+        if ratings:
+            with transaction(cur):
+                upsert_ratings(cur, request.publicKey, ratings)
+
+        return {"message": f"Successfully rated {len(ratings)} chunks"}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/get_document_ratings")
-async def get_document_ratings(ragServerSecret: str):
+def get_document_ratings(ragServerSecret: str, cur=Depends(get_cursor)):
     verify_rag_server_secret(ragServerSecret)
     
     try:
         # Get all ratings grouped by document
-        ratings = SharedState.conn.execute("""
-            WITH chunk_ratings AS (
-                SELECT 
-                    c.document_id,
-                    SUM(r.rating) as total_rating
-                FROM chunks c
-                LEFT JOIN ratings r ON c.chunk_id = r.chunk_id
-                GROUP BY c.document_id
-            )
-            SELECT 
+        ratings = cur.execute("""
+            SELECT
                 d.document_id,
                 d.document_name,
-                COALESCE(cr.total_rating, 0) as rating
+                COALESCE(ds.total_rating, 0) as rating
             FROM documents d
-            LEFT JOIN chunk_ratings cr ON d.document_id = cr.document_id
+            LEFT JOIN document_stats ds ON d.document_id = ds.document_id
         """).fetchall()
         
         return {
@@ -70,16 +64,14 @@ async def get_document_ratings(ragServerSecret: str):
 
 
 @router.get("/get_document_rating/{document_id}")
-async def get_document_rating(document_id: str, ragServerSecret: str):
+def get_document_rating(document_id: str, ragServerSecret: str, cur=Depends(get_cursor)):
     verify_rag_server_secret(ragServerSecret)
     
     try:
-        rating = SharedState.conn.execute("""
-            SELECT COALESCE(SUM(r.rating), 0) as total_rating
-            FROM chunks c
-            LEFT JOIN ratings r ON c.chunk_id = r.chunk_id
-            WHERE c.document_id = ?
-            GROUP BY c.document_id
+        rating = cur.execute("""
+            SELECT total_rating
+            FROM document_stats
+            WHERE document_id = ?
         """, [document_id]).fetchone()
         
         return {"rating": rating[0] if rating else 0}
@@ -87,24 +79,21 @@ async def get_document_rating(document_id: str, ragServerSecret: str):
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.post("/get-chunk-ratings")
-async def get_chunk_ratings(request: ChunkRatingsRequest):
+def get_chunk_ratings(request: ChunkRatingsRequest, cur=Depends(get_cursor)):
     try:
         verify_rag_server_secret(request.ragServerSecret)
             
         if not request.chunkIds or not request.publicKey:
             raise HTTPException(status_code=400, detail="Missing required parameters")
 
-        # Query the ratings for the given chunks and user
-        ratings_data = {}
-        for chunk_id in request.chunkIds:
-            rating = SharedState.conn.execute("""
-                SELECT rating 
-                FROM ratings 
-                WHERE chunk_id = ? AND public_key = ?
-            """, (chunk_id, request.publicKey)).fetchone()
-            
-            if rating:
-                ratings_data[chunk_id] = rating[0]
+        # One lookup for all requested chunks of this user
+        rows = cur.execute("""
+            SELECT r.chunk_id, r.rating
+            FROM (SELECT DISTINCT UNNEST(?::VARCHAR[]) AS chunk_id) AS requested
+            JOIN ratings r ON r.chunk_id = requested.chunk_id
+            WHERE r.public_key = ?
+        """, (request.chunkIds, request.publicKey)).fetchall()
+        ratings_data = {chunk_id: rating for chunk_id, rating in rows}
         
         return {"ratings": ratings_data}
     except Exception as e:
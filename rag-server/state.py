@@ -1,8 +1,20 @@
 class SharedState:
-    collection = None
+    vector_index = None
     conn = None
+    gateway = None
+    http_client = None
+    key_broker = None
+    outbox = None
+    pdf_cache = None
+    query_cache = None
+    blob_store = None
     RAG_SERVER_SECRET = None
     KEY_SERVER_SECRET = None
     KEY_SERVER_API = None
     PDF_STORAGE_PATH = None
     MAX_CHUNK_PRICE = None
+    MAX_QUERY_RESULTS = None
+    VECTOR_ADD_BATCH_SIZE = None
+    KEY_REQUEST_BATCH_WINDOW_MS = None
+    KEY_REQUEST_MAX_BATCH = None
+    RATE_KEY_OWNERS_DELAY = None
@@ -0,0 +1,162 @@
+import base64
+import threading
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import models
+from routes.document_routes import router
+from state import SharedState
+from utils.blob_store import BlobStore
+from utils.db import WRITE_LOCK
+from utils.query_cache import QueryCache
+from utils.vector_index import MmapVectorIndex
+
+SECRET = "secret"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("RAG_SERVER_SECRET", SECRET)
+    monkeypatch.setattr(models, "DUCKDB_PATH", str(tmp_path / "rag.db"))
+    conn = models.init_database()
+    monkeypatch.setattr(SharedState, "conn", conn)
+    monkeypatch.setattr(SharedState, "blob_store", BlobStore(conn, str(tmp_path / "documents")))
+    monkeypatch.setattr(SharedState, "vector_index", MmapVectorIndex(str(tmp_path / "vectors")))
+    monkeypatch.setattr(SharedState, "query_cache", QueryCache())
+    monkeypatch.setattr(SharedState, "VECTOR_ADD_BATCH_SIZE", 100)
+
+    app = FastAPI()
+    app.include_router(router)
+    with TestClient(app) as client:
+        yield client
+    conn.close()
+
+
+def stage_blob(client, document_id, data=b"ciphertext"):
+    return client.post(
+        "/upload_document_blob",
+        params={"documentId": document_id, "ragServerSecret": SECRET},
+        content=data
+    )
+
+
+def upload(client, document_id):
+    return client.post("/upload", json={
+        "chunks": [{
+            "id": f"{document_id}-0",
+            "embedding": [0.1, 0.2, 0.3],
+            "encrypted_content": base64.b64encode(b"chunk").decode()
+        }],
+        "publicKey": "0xowner",
+        "documentId": document_id,
+        "documentTitle": f"Title of {document_id}",
+        "keyServerPublicKey": "0xkeyserver",
+        "ragServerSecret": SECRET
+    })
+
+
+def blob_rows():
+    return SharedState.conn.execute("SELECT blob_hash, ref_count FROM blobs").fetchall()
+
+
+def staged_rows():
+    return SharedState.conn.execute("SELECT document_id FROM staged_blobs").fetchall()
+
+
+def expire_blobs():
+    SharedState.blob_store.grace = -1
+    SharedState.blob_store.collect_garbage()
+
+
+def test_upload_attaches_staged_blob(client):
+    blob_hash = stage_blob(client, "d1").json()["sha256"]
+    assert blob_rows() == [(blob_hash, 0)]
+
+    assert upload(client, "d1").status_code == 200
+    assert blob_rows() == [(blob_hash, 1)]
+    assert staged_rows() == []
+
+
+def test_staging_rejects_existing_document(client):
+    stage_blob(client, "d1")
+    upload(client, "d1")
+
+    response = stage_blob(client, "d1", b"other ciphertext")
+
+    assert response.status_code == 409
+    assert len(blob_rows()) == 1
+
+
+def test_blob_collected_before_upload(client):
+    stage_blob(client, "d1")
+    expire_blobs()
+    assert blob_rows() == [] and staged_rows() == []
+
+    assert upload(client, "d1").status_code == 400
+
+
+def test_blob_collected_during_upload(client, monkeypatch):
+    blob_store = SharedState.blob_store
+    staged_blob = blob_store.staged_blob
+
+    def staged_blob_then_collect(cursor, document_id):
+        # Garbage collection runs right after the route's first check
+        blob_hash = staged_blob(cursor, document_id)
+        monkeypatch.setattr(blob_store, "staged_blob", staged_blob)
+        expire_blobs()
+        return blob_hash
+
+    stage_blob(client, "d1")
+    monkeypatch.setattr(blob_store, "staged_blob", staged_blob_then_collect)
+
+    response = upload(client, "d1")
+
+    assert response.status_code == 410
+    assert SharedState.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] == 0
+    blob_store.grace = 3600.0
+    stage_blob(client, "d1")
+    assert upload(client, "d1").status_code == 200
+
+
+def test_vectors_are_added_outside_the_write_lock(client, monkeypatch):
+    vector_index = SharedState.vector_index
+    add = vector_index.add
+    lock_free = []
+
+    def add_checking_lock(ids, embeddings):
+        # The write lock is reentrant, so probe it from another thread
+        def probe():
+            lock_free.append(WRITE_LOCK.acquire(timeout=1))
+            if lock_free[-1]:
+                WRITE_LOCK.release()
+
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        add(ids, embeddings)
+
+    monkeypatch.setattr(vector_index, "add", add_checking_lock)
+    stage_blob(client, "d1")
+
+    assert upload(client, "d1").status_code == 200
+    assert lock_free == [True]
+
+
+def test_failed_vector_insert_undoes_upload(client, monkeypatch):
+    vector_index = SharedState.vector_index
+    add = vector_index.add
+
+    def failing_add(ids, embeddings):
+        raise RuntimeError("vector index unavailable")
+
+    monkeypatch.setattr(vector_index, "add", failing_add)
+    blob_hash = stage_blob(client, "d1").json()["sha256"]
+
+    assert upload(client, "d1").status_code == 500
+    for table in ("chunks", "documents", "document_stats", "document_blobs"):
+        assert SharedState.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
+    assert blob_rows() == [(blob_hash, 0)]
+    assert staged_rows() == [("d1",)]
+
+    monkeypatch.setattr(vector_index, "add", add)
+    assert upload(client, "d1").status_code == 200
@@ -0,0 +1,69 @@
+from collections import Counter
+from types import SimpleNamespace
+import pytest
+from state import SharedState
+from utils.hedera_interactions import RATE_BATCH_MAX_ENTRIES, merge_key_owner_ratings
+
+ALICE = "0x" + "aa" * 20
+BOB = "0x" + "bb" * 20
+
+
+class FakeKeyContract:
+    """Open rating bookkeeping of KeyContract.sol."""
+
+    def __init__(self):
+        self.open_ratings = Counter()
+        self.reputation = Counter()
+
+    def publish_chunk_keys(self, key_owners):
+        for owner in key_owners:
+            self.open_ratings[owner] += 1
+
+    def rate_key_owners(self, key_owners, ratings):
+        assert len(key_owners) == len(ratings), "Arrays must have the same length"
+        for owner, rating in zip(key_owners, ratings):
+            assert self.open_ratings[owner] > 0, "Key owner has no open ratings"
+            self.open_ratings[owner] -= 1
+            self.reputation[owner] = self.reputation[owner] + 1 if rating else 0
+
+
+@pytest.fixture
+def contract(monkeypatch):
+    contract = FakeKeyContract()
+    functions = SimpleNamespace(rateKeyOwners=lambda key_owners, ratings: (key_owners, ratings))
+    monkeypatch.setattr(SharedState, "gateway", SimpleNamespace(functions=functions))
+    return contract
+
+
+def test_merged_batch_closes_every_open_rating(contract):
+    contract.publish_chunk_keys([ALICE, ALICE, BOB])
+    contract.publish_chunk_keys([ALICE, BOB])
+    items = [
+        ("i1", {"key_owners": [ALICE, ALICE, BOB], "ratings": [True, False, True]}),
+        ("i2", {"key_owners": [ALICE, BOB], "ratings": [True, True]}),
+    ]
+
+    batches = merge_key_owner_ratings(items)
+
+    assert len(batches) == 1
+    item_ids, (key_owners, ratings), _ = batches[0]
+    assert item_ids == ["i1", "i2"]
+    contract.rate_key_owners(key_owners, ratings)
+    assert sum(contract.open_ratings.values()) == 0
+    assert contract.reputation == Counter({ALICE: 1, BOB: 2})
+
+
+def test_batches_are_capped_without_splitting_items(contract):
+    owners = [ALICE] * (RATE_BATCH_MAX_ENTRIES - 1)
+    contract.publish_chunk_keys(owners + [BOB, BOB])
+    items = [
+        ("i1", {"key_owners": owners, "ratings": [True] * len(owners)}),
+        ("i2", {"key_owners": [BOB, BOB], "ratings": [True, True]}),
+    ]
+
+    batches = merge_key_owner_ratings(items)
+
+    assert [item_ids for item_ids, _, _ in batches] == [["i1"], ["i2"]]
+    for _, (key_owners, ratings), _ in batches:
+        contract.rate_key_owners(key_owners, ratings)
+    assert sum(contract.open_ratings.values()) == 0
@@ -0,0 +1,255 @@
+"""Content-addressed store for encrypted document blobs.
+
+Blobs are stored once under `PDF_STORAGE_PATH/blobs/<sha256[:2]>/<sha256>`, no
+matter how many documents upload the same ciphertext. `document_blobs` maps
+document ids to blobs and `blobs.ref_count` counts those links. A blob streamed
+ahead of its /upload call is only recorded in `staged_blobs`, without a
+reference, and /upload links it. Blobs without links are removed by a periodic
+garbage collection pass once they have been unreferenced for the grace period,
+which also covers staged blobs whose /upload call never arrived.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from fastapi.concurrency import run_in_threadpool
+from utils.db import transaction
+from utils.metrics import BLOB_STORE_BYTES, BLOB_UPLOADS
+from utils.streams import write_stream_to_file
+
+BLOB_STORE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS blobs (
+        blob_hash VARCHAR PRIMARY KEY,
+        size BIGINT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        updated_at DOUBLE NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS document_blobs (
+        document_id VARCHAR PRIMARY KEY,
+        blob_hash VARCHAR NOT NULL
+    );
+"""
+
+# Separate from BLOB_STORE_SCHEMA, which already shipped in a migration
+STAGED_BLOB_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS staged_blobs (
+        document_id VARCHAR PRIMARY KEY,
+        blob_hash VARCHAR NOT NULL,
+        staged_at DOUBLE NOT NULL
+    )
+"""
+
+TEMP_PREFIX = ".upload-"
+HASH_READ_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """Deduplicating blob storage with reference counting and garbage collection."""
+
+    def __init__(self, conn, storage_path, gc_interval=3600.0, grace=3600.0):
+        self.conn = conn
+        self.storage_path = storage_path
+        self.root = os.path.join(storage_path, "blobs")
+        self.gc_interval = gc_interval
+        self.grace = grace
+        os.makedirs(self.root, exist_ok=True)
+        # Placing a blob file and collecting it must not interleave
+        self._files_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def document_path(self, document_id):
+        """Path of the blob of a document, or None if it has none."""
+        cursor = self.conn.cursor()
+        try:
+            row = cursor.execute(
+                "SELECT blob_hash FROM document_blobs WHERE document_id = ?", [document_id]
+            ).fetchone()
+        finally:
+            cursor.close()
+        return self.blob_path(row[0]) if row else None
+
+    def has_document(self, cursor, document_id):
+        return cursor.execute(
+            "SELECT 1 FROM document_blobs WHERE document_id = ?", [document_id]
+        ).fetchone() is not None
+
+    async def put_stream(self, chunks, decode_base64=False):
+        """Store an async byte stream, hashing it while it is written. Returns (blob_hash, size)."""
+        digest = hashlib.sha256()
+        temp_path = os.path.join(self.root, f"{TEMP_PREFIX}{uuid.uuid4().hex}")
+        size = await write_stream_to_file(chunks, temp_path, decode_base64=decode_base64, digest=digest)
+        return await run_in_threadpool(self._place, temp_path, digest.hexdigest(), size)
+
+    def put_bytes(self, data):
+        """Store an in-memory blob. Returns (blob_hash, size)."""
+        temp_path = os.path.join(self.root, f"{TEMP_PREFIX}{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self._place(temp_path, hashlib.sha256(data).hexdigest(), len(data))
+
+    def _place(self, temp_path, blob_hash, size):
+        # The row is touched before the file is placed, so the collector's grace
+        # period covers the time until a document links the blob
+        cursor = self.conn.cursor()
+        try:
+            with self._files_lock:
+                with transaction(cursor):
+                    cursor.execute("""
+                        INSERT INTO blobs (blob_hash, size, ref_count, updated_at) VALUES (?, ?, 0, ?)
+                        ON CONFLICT (blob_hash) DO UPDATE SET updated_at = excluded.updated_at
+                    """, (blob_hash, size, time.time()))
+                path = self.blob_path(blob_hash)
+                if os.path.exists(path):
+                    os.remove(temp_path)
+                    BLOB_UPLOADS.labels("deduplicated").inc()
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temp_path, path)
+                    BLOB_UPLOADS.labels("stored").inc()
+        except BaseException:
+            # Adopted legacy files are never removed on failure, they may be the only copy
+            if os.path.basename(temp_path).startswith(TEMP_PREFIX) and os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            cursor.close()
+        return blob_hash, size
+
+    def stage(self, document_id, blob_hash):
+        """Remember a streamed blob for the document's /upload call, without taking a reference."""
+        cursor = self.conn.cursor()
+        try:
+            with transaction(cursor):
+                cursor.execute("""
+                    INSERT INTO staged_blobs (document_id, blob_hash, staged_at) VALUES (?, ?, ?)
+                    ON CONFLICT (document_id) DO UPDATE SET
+                        blob_hash = excluded.blob_hash,
+                        staged_at = excluded.staged_at
+                """, (document_id, blob_hash, time.time()))
+        finally:
+            cursor.close()
+
+    def staged_blob(self, cursor, document_id):
+        """Hash of the blob staged for a document, or None."""
+        row = cursor.execute(
+            "SELECT blob_hash FROM staged_blobs WHERE document_id = ?", [document_id]
+        ).fetchone()
+        return row[0] if row else None
+
+    def attach(self, cursor, document_id, blob_hash):
+        """Link a document to a blob, releasing its previous one. Runs in the caller's transaction."""
+        cursor.execute("DELETE FROM staged_blobs WHERE document_id = ?", [document_id])
+        previous = cursor.execute(
+            "SELECT blob_hash FROM document_blobs WHERE document_id = ?", [document_id]
+        ).fetchone()
+        if previous and previous[0] == blob_hash:
+            return
+        if cursor.execute("""
+            UPDATE blobs SET ref_count = ref_count + 1, updated_at = ? WHERE blob_hash = ?
+            RETURNING blob_hash
+        """, (time.time(), blob_hash)).fetchone() is None:
+            raise ValueError(f"Unknown blob {blob_hash}")
+        cursor.execute("""
+            INSERT INTO document_blobs (document_id, blob_hash) VALUES (?, ?)
+            ON CONFLICT (document_id) DO UPDATE SET blob_hash = excluded.blob_hash
+        """, (document_id, blob_hash))
+        if previous:
+            self._release(cursor, previous[0])
+
+    def detach(self, cursor, document_id):
+        """Remove a document's link to its blob. Runs in the caller's transaction."""
+        row = cursor.execute(
+            "DELETE FROM document_blobs WHERE document_id = ? RETURNING blob_hash", [document_id]
+        ).fetchone()
+        if row:
+            self._release(cursor, row[0])
+
+    def _release(self, cursor, blob_hash):
+        cursor.execute(
+            "UPDATE blobs SET ref_count = ref_count - 1, updated_at = ? WHERE blob_hash = ?",
+            (time.time(), blob_hash)
+        )
+
+    def adopt_legacy_files(self):
+        """Move `{document_id}.raw` files from before the blob store into it, once."""
+        for name in os.listdir(self.storage_path):
+            if not name.endswith(".raw"):
+                continue
+            path = os.path.join(self.storage_path, name)
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for piece in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                    digest.update(piece)
+            blob_hash, _ = self._place(path, digest.hexdigest(), os.path.getsize(path))
+
+            document_id = name[:-len(".raw")]
+            cursor = self.conn.cursor()
+            try:
+                with transaction(cursor):
+                    if not self.has_document(cursor, document_id):
+                        self.attach(cursor, document_id, blob_hash)
+            finally:
+                cursor.close()
+            print(f"Moved {name} into the blob store as {blob_hash}")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="blob-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                print(f"Blob garbage collection failed: {e}")
+            self._stop.wait(self.gc_interval)
+
+    def collect_garbage(self):
+        """Remove blobs unreferenced for the grace period and stray files. Returns the files removed."""
+        cutoff = time.time() - self.grace
+        removed = 0
+        cursor = self.conn.cursor()
+        try:
+            with self._files_lock:
+                with transaction(cursor):
+                    # Blobs staged more recently are kept, so a staging record never outlives its blob
+                    cursor.execute("DELETE FROM staged_blobs WHERE staged_at < ?", [cutoff])
+                    released = cursor.execute("""
+                        DELETE FROM blobs
+                        WHERE ref_count <= 0 AND updated_at < ?
+                            AND blob_hash NOT IN (SELECT blob_hash FROM staged_blobs)
+                        RETURNING blob_hash
+                    """, [cutoff]).fetchall()
+                for (blob_hash,) in released:
+                    path = self.blob_path(blob_hash)
+                    if os.path.exists(path):
+                        os.remove(path)
+                        removed += 1
+
+                # Leftovers of interrupted uploads and files whose row is gone
+                known = {row[0] for row in cursor.execute("SELECT blob_hash FROM blobs").fetchall()}
+                for directory, _, names in os.walk(self.root):
+                    for name in names:
+                        path = os.path.join(directory, name)
+                        stray = name.startswith(TEMP_PREFIX) or (directory != self.root and name not in known)
+                        if stray and os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+
+            BLOB_STORE_BYTES.set(
+                cursor.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            )
+        finally:
+            cursor.close()
+        return removed
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import requests
+from web3 import Web3, AsyncWeb3
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_CONTRACT_PATH = './contract/KeyContract.json'
+
+# Node errors meaning the local nonce counter is out of step with the chain
+NONCE_ERROR_MARKERS = ("nonce", "replacement transaction underpriced")
+
+
+def is_nonce_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in NONCE_ERROR_MARKERS)
+
+
+class NonceManager:
+    """Hands out transaction nonces locally so concurrent sends never collide."""
+
+    def __init__(self, web3, address):
+        self.web3 = web3
+        self.address = address
+        self._lock = threading.Lock()
+        self._next_nonce = None
+
+    def next(self):
+        with self._lock:
+            if self._next_nonce is None:
+                # Include pending transactions so a restart does not reuse in-flight nonces
+                self._next_nonce = self.web3.eth.get_transaction_count(self.address, 'pending')
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
+
+    async def next_async(self, async_web3):
+        """Like next(), but reads the initial nonce through an async provider."""
+        if self._next_nonce is None:
+            pending = await async_web3.eth.get_transaction_count(self.address, 'pending')
+            with self._lock:
+                if self._next_nonce is None:
+                    self._next_nonce = pending
+        return self.next()
+
+    def reset(self):
+        """Forget the local counter so the next nonce is re-read from the chain."""
+        with self._lock:
+            self._next_nonce = None
+
+
+class ContractGateway:
+    """Long-lived connection to the KeyContract.
+
+    The ABI, contract object, operator account and HTTP session are created once
+    and reused by every call instead of being rebuilt per transaction.
+    """
+
+    def __init__(self, contract_address, relay_endpoint, private_key, contract_path=DEFAULT_CONTRACT_PATH):
+        with open(contract_path) as f:
+            self.abi = json.load(f)['abi']
+
+        self.session = requests.Session()
+        self.web3 = Web3(Web3.HTTPProvider(relay_endpoint, session=self.session))
+        self.private_key = private_key
+        self.account = self.web3.eth.account.from_key(private_key)
+        self.address = Web3.to_checksum_address(contract_address)
+        self.contract = self.web3.eth.contract(address=self.address, abi=self.abi)
+        self.nonces = NonceManager(self.web3, self.account.address)
+
+        # Async counterparts used from the event loop; they share the nonce counter above
+        self.async_web3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(relay_endpoint))
+        self.async_contract = self.async_web3.eth.contract(address=self.address, abi=self.abi)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.getenv('KEY_CONTRACT_ADDRESS'),
+            os.getenv('RELAY_ENDPOINT'),
+            os.getenv('OPERATOR_PRIVATE_KEY'),
+            os.getenv('KEY_CONTRACT_PATH', DEFAULT_CONTRACT_PATH),
+        )
+
+    @property
+    def functions(self):
+        return self.contract.functions
+
+    @property
+    def async_functions(self):
+        return self.async_contract.functions
+
+    def call(self, contract_function, gas=300000):
+        return contract_function.call({'from': self.account.address, 'gas': gas})
+
+    def send(self, contract_function, gas=600000):
+        """Sign and submit a contract call with a locally assigned nonce, returning the tx hash."""
+        nonce = self.nonces.next()
+        broadcast = False
+        try:
+            transaction = contract_function.build_transaction({
+                'from': self.account.address,
+                'gas': gas,
+                'nonce': nonce
+            })
+            signed_tx = self.web3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+            broadcast = True
+            return self.web3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception as e:
+            # A nonce that never reached the node would leave a gap, so re-read it. After the
+            # broadcast only resynchronise when the node rejected the nonce, since the
+            # transaction may still have been sent and re-reading could reuse its nonce
+            if not broadcast or is_nonce_error(e):
+                self.nonces.reset()
+            raise
+
+    def wait_for_receipt(self, tx_hash, timeout=120):
+        return self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=timeout)
+
+    def transact(self, contract_function, gas=600000):
+        """Send a transaction and block until its receipt is available."""
+        return self.wait_for_receipt(self.send(contract_function, gas))
+
+    async def send_async(self, contract_function, gas=600000):
+        """Async variant of send() for functions taken from async_functions."""
+        nonce = await self.nonces.next_async(self.async_web3)
+        broadcast = False
+        try:
+            transaction = await contract_function.build_transaction({
+                'from': self.account.address,
+                'gas': gas,
+                'nonce': nonce
+            })
+            signed_tx = self.async_web3.eth.account.sign_transaction(transaction, private_key=self.private_key)
+            broadcast = True
+            return await self.async_web3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception as e:
+            if not broadcast or is_nonce_error(e):
+                self.nonces.reset()
+            raise
+
+    async def wait_for_receipt_async(self, tx_hash, timeout=120, poll_latency=0.5):
+        return await self.async_web3.eth.wait_for_transaction_receipt(tx_hash, timeout=timeout, poll_latency=poll_latency)
+
+    async def transact_async(self, contract_function, gas=600000):
+        """Send a transaction and await its receipt without blocking the event loop."""
+        return await self.wait_for_receipt_async(await self.send_async(contract_function, gas))
+
+    def close(self):
+        self.session.close()
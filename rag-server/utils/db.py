@@ -0,0 +1,121 @@
+import threading
+from contextlib import contextmanager
+from state import SharedState
+from utils.document_stats import record_decryption, record_chunk_rewards, record_ratings
+
+# DuckDB runs concurrent readers in parallel but aborts conflicting writers, so
+# writes from different request threads are serialised in this process.
+WRITE_LOCK = threading.RLock()
+
+
+def get_cursor():
+    """FastAPI dependency yielding a per-request DuckDB cursor.
+
+    Cursors are separate connections to the same database, so handlers running
+    in the threadpool never interleave statements on the shared connection.
+    """
+    cursor = SharedState.conn.cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def transaction(conn):
+    """Run the enclosed statements in one DuckDB write transaction, rolling back on error."""
+    with WRITE_LOCK:
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def _check_same_length(first, second):
+    # UNNEST pads the shorter of two lists with NULLs instead of failing
+    if len(first) != len(second):
+        raise ValueError(f"Expected lists of the same length, got {len(first)} and {len(second)}")
+
+
+def insert_chunks(conn, chunk_ids, ciphertexts, document_id, public_key, key_server_public_key):
+    """Insert the encrypted chunks of one document with a single set-based statement.
+
+    `ciphertexts` are the raw OpenSSL-format bytes, not base64.
+    """
+    _check_same_length(chunk_ids, ciphertexts)
+    conn.execute("""
+        INSERT OR REPLACE INTO chunks
+        (chunk_id, document_id, ciphertext, encrypted, reward, public_key, key_server_public_key)
+        SELECT staged.chunk_id, ?, staged.ciphertext, TRUE, 0.0, ?, ?
+        FROM (
+            SELECT UNNEST(?::VARCHAR[]) AS chunk_id, UNNEST(?::BLOB[]) AS ciphertext
+        ) AS staged
+    """, (document_id, public_key, key_server_public_key, chunk_ids, ciphertexts))
+
+
+def store_decrypted_chunks(conn, chunk_ids, contents):
+    """Store the plaintext of chunks, drop their ciphertext and mark them as decrypted."""
+    _check_same_length(chunk_ids, contents)
+    record_decryption(conn, chunk_ids)
+    conn.execute("""
+        UPDATE chunks
+        SET content = staged.content, encrypted = FALSE, ciphertext = NULL
+        FROM (
+            SELECT UNNEST(?::VARCHAR[]) AS chunk_id, UNNEST(?::VARCHAR[]) AS content
+        ) AS staged
+        WHERE chunks.chunk_id = staged.chunk_id
+    """, (chunk_ids, contents))
+
+
+def add_chunk_rewards(conn, chunk_ids, rewards):
+    """Add rewards to chunks, summing repeated chunk ids first."""
+    _check_same_length(chunk_ids, rewards)
+    record_chunk_rewards(conn, chunk_ids, rewards)
+    conn.execute("""
+        UPDATE chunks
+        SET reward = chunks.reward + staged.reward
+        FROM (
+            SELECT chunk_id, SUM(reward) AS reward
+            FROM (
+                SELECT UNNEST(?::VARCHAR[]) AS chunk_id, UNNEST(?::DOUBLE[]) AS reward
+            )
+            GROUP BY chunk_id
+        ) AS staged
+        WHERE chunks.chunk_id = staged.chunk_id
+    """, (chunk_ids, rewards))
+
+
+def upsert_ratings(conn, public_key, ratings):
+    """Write a user's {chunk_id: rating} with one statement, replacing their previous ratings."""
+    chunk_ids = list(ratings.keys())
+    values = list(ratings.values())
+    record_ratings(conn, public_key, chunk_ids, values)
+    conn.execute("""
+        INSERT INTO ratings
+        (rating_id, public_key, chunk_id, rating)
+        SELECT gen_random_uuid()::VARCHAR, ?, staged.chunk_id, staged.rating
+        FROM (
+            SELECT UNNEST(?::VARCHAR[]) AS chunk_id, UNNEST(?::INTEGER[]) AS rating
+        ) AS staged
+        ON CONFLICT (chunk_id, public_key) DO UPDATE SET rating = excluded.rating
+    """, (public_key, chunk_ids, values))
+
+
+def add_embeddings(vector_index, ids, embeddings, batch_size):
+    """Add embeddings to the vector store in bounded batches.
+
+    If a batch fails, the batches already added are removed again before re-raising.
+    """
+    added = []
+    try:
+        for start in range(0, len(ids), batch_size):
+            batch_ids = ids[start:start + batch_size]
+            vector_index.add(batch_ids, embeddings[start:start + batch_size])
+            added.extend(batch_ids)
+    except Exception:
+        if added:
+            vector_index.delete(added)
+        raise
@@ -0,0 +1,77 @@
+"""Key-server client for buying whole documents.
+
+The key-server streams a document's keys as NDJSON, the document key first
+and then one line per chunk key, so decryption can start on the first batch.
+"""
+import json
+import requests
+from fastapi import HTTPException
+from state import SharedState
+
+# Chunk keys handed to the decryptor at a time
+DOCUMENT_KEY_BATCH_SIZE = 500
+
+# Shared so purchases reuse the connection to the key-server
+_session = requests.Session()
+
+
+def _raise_for_status(response):
+    if response.status_code != 200:
+        detail = response.text
+        response.close()
+        raise HTTPException(status_code=response.status_code, detail=detail)
+
+
+def open_document_keys(document_id, batch_size=DOCUMENT_KEY_BATCH_SIZE):
+    """Request the key bundle of a document.
+
+    Returns (document_key, chunk_key_batches), where chunk_key_batches yields
+    lists of {chunk_id, secret_key, public_key} while the response streams in.
+    """
+    response = _session.post(
+        f"{SharedState.KEY_SERVER_API}/get-document-keys",
+        json={"key_server_secret": SharedState.KEY_SERVER_SECRET, "document_id": document_id},
+        stream=True
+    )
+    _raise_for_status(response)
+    lines = (json.loads(line) for line in response.iter_lines() if line)
+    try:
+        document_key = next(lines)["secret_key"]
+    except BaseException:
+        response.close()
+        raise
+    return document_key, _batches(response, lines, batch_size)
+
+
+def _batches(response, lines, batch_size):
+    try:
+        batch = []
+        for key in lines:
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        response.close()
+
+
+def fetch_document_key(document_id):
+    """Passphrase of a document's PDF."""
+    response = _session.post(
+        f"{SharedState.KEY_SERVER_API}/get-keys-for-document",
+        json={"key_server_secret": SharedState.KEY_SERVER_SECRET, "document_id": document_id}
+    )
+    _raise_for_status(response)
+    return response.json()
+
+
+def fetch_chunk_keys(chunk_ids):
+    """Keys of the given chunks, for chunk keys the key-server has not linked to a document."""
+    response = _session.post(
+        f"{SharedState.KEY_SERVER_API}/get-keys/",
+        json={"chunk_ids": chunk_ids, "whole_document": True}
+    )
+    _raise_for_status(response)
+    return response.json()
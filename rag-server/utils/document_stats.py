@@ -0,0 +1,123 @@
+"""Maintenance of the per-document aggregates in the `document_stats` table.
+
+Uploads and deletes recompute the affected document, every other write applies
+a delta in the same transaction, so the dashboard endpoints never scan `chunks`.
+"""
+
+
+def refresh_document_stats(conn, document_ids=None):
+    """Recompute the stats of the given documents, or of every document missing from the table."""
+    if document_ids is None:
+        document_filter = "document_id NOT IN (SELECT document_id FROM document_stats)"
+        params = []
+    else:
+        document_filter = "document_id IN (SELECT UNNEST(?::VARCHAR[]))"
+        params = [list(document_ids)] * 2
+
+    conn.execute(f"""
+        INSERT OR REPLACE INTO document_stats
+        (document_id, public_key, total_chunks, encrypted_chunks, total_reward, upvotes, downvotes, total_rating)
+        SELECT
+            cs.document_id,
+            cs.public_key,
+            cs.total_chunks,
+            cs.encrypted_chunks,
+            cs.total_reward,
+            COALESCE(rs.upvotes, 0),
+            COALESCE(rs.downvotes, 0),
+            COALESCE(rs.total_rating, 0)
+        FROM (
+            SELECT
+                document_id,
+                ANY_VALUE(public_key) AS public_key,
+                COUNT(*) AS total_chunks,
+                SUM(CASE WHEN encrypted THEN 1 ELSE 0 END) AS encrypted_chunks,
+                COALESCE(SUM(reward), 0) AS total_reward
+            FROM chunks
+            WHERE {document_filter}
+            GROUP BY document_id
+        ) cs
+        LEFT JOIN (
+            SELECT
+                c.document_id,
+                SUM(CASE WHEN r.rating > 0 THEN 1 ELSE 0 END) AS upvotes,
+                SUM(CASE WHEN r.rating < 0 THEN 1 ELSE 0 END) AS downvotes,
+                SUM(r.rating) AS total_rating
+            FROM chunks c
+            JOIN ratings r ON c.chunk_id = r.chunk_id
+            WHERE {document_filter}
+            GROUP BY c.document_id
+        ) rs ON cs.document_id = rs.document_id
+    """, params)
+
+
+def delete_document_stats(conn, document_id):
+    conn.execute("DELETE FROM document_stats WHERE document_id = ?", [document_id])
+
+
+def record_decryption(conn, chunk_ids):
+    """Decrement encrypted counts for the chunks that are still encrypted; call before updating them."""
+    conn.execute("""
+        UPDATE document_stats
+        SET encrypted_chunks = document_stats.encrypted_chunks - changed.decrypted
+        FROM (
+            SELECT document_id, COUNT(*) AS decrypted
+            FROM chunks
+            WHERE encrypted AND chunk_id IN (SELECT UNNEST(?::VARCHAR[]))
+            GROUP BY document_id
+        ) AS changed
+        WHERE document_stats.document_id = changed.document_id
+    """, [chunk_ids])
+
+
+def record_chunk_rewards(conn, chunk_ids, rewards):
+    conn.execute("""
+        UPDATE document_stats
+        SET total_reward = document_stats.total_reward + staged.reward
+        FROM (
+            SELECT c.document_id, SUM(s.reward) AS reward
+            FROM (
+                SELECT UNNEST(?::VARCHAR[]) AS chunk_id, UNNEST(?::DOUBLE[]) AS reward
+            ) AS s
+            JOIN chunks c ON c.chunk_id = s.chunk_id
+            GROUP BY c.document_id
+        ) AS staged
+        WHERE document_stats.document_id = staged.document_id
+    """, (chunk_ids, rewards))
+
+
+def record_document_reward(conn, document_id, chunk_reward):
+    """Account for `chunk_reward` being added to every chunk of a document."""
+    conn.execute("""
+        UPDATE document_stats
+        SET total_reward = total_reward + ? * total_chunks
+        WHERE document_id = ?
+    """, (chunk_reward, document_id))
+
+
+def record_ratings(conn, public_key, chunk_ids, ratings):
+    """Apply the change from a user's current ratings of the chunks to `ratings`; call before writing them.
+
+    `chunk_ids` must not contain duplicates.
+    """
+    conn.execute("""
+        UPDATE document_stats
+        SET
+            upvotes = document_stats.upvotes + changed.upvotes,
+            downvotes = document_stats.downvotes + changed.downvotes,
+            total_rating = document_stats.total_rating + changed.total_rating
+        FROM (
+            SELECT
+                c.document_id,
+                SUM((s.rating > 0)::INTEGER - (COALESCE(r.rating, 0) > 0)::INTEGER) AS upvotes,
+                SUM((s.rating < 0)::INTEGER - (COALESCE(r.rating, 0) < 0)::INTEGER) AS downvotes,
+                SUM(s.rating - COALESCE(r.rating, 0)) AS total_rating
+            FROM (
+                SELECT UNNEST($2::VARCHAR[]) AS chunk_id, UNNEST($3::INTEGER[]) AS rating
+            ) AS s
+            JOIN chunks c ON c.chunk_id = s.chunk_id
+            LEFT JOIN ratings r ON r.chunk_id = s.chunk_id AND r.public_key = $1
+            GROUP BY c.document_id
+        ) AS changed
+        WHERE document_stats.document_id = changed.document_id
+    """, (public_key, chunk_ids, ratings))
@@ -0,0 +1,88 @@
+import base64
+import binascii
+import numpy as np
+from fastapi import HTTPException
+
+# Binary embeddings are little-endian float32, base64 encoded
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+
+def _invalid(detail):
+    return HTTPException(status_code=400, detail=detail)
+
+
+def _decode_bytes(encoded):
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raise _invalid("Embedding is not valid base64")
+
+
+def decode_embedding(encoded, dim=None):
+    """Decode one base64 float32 embedding into a NumPy vector."""
+    raw = _decode_bytes(encoded)
+    if len(raw) % EMBEDDING_DTYPE.itemsize:
+        raise _invalid("Embedding length is not a multiple of 4 bytes")
+    vector = np.frombuffer(raw, dtype=EMBEDDING_DTYPE)
+    if dim is not None and vector.shape[0] != dim:
+        raise _invalid(f"Embedding has dimension {vector.shape[0]}, expected {dim}")
+    return vector
+
+
+def _float_matrix(vectors, dim=None):
+    """Stack JSON float lists into a float32 matrix, all of the same dimension."""
+    dims = {len(vector) for vector in vectors}
+    if dim is not None:
+        dims.add(dim)
+    if len(dims) > 1:
+        raise _invalid("Embeddings do not all have the same dimension")
+    return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), dims.pop() if dims else 0)
+
+
+def chunk_embeddings(document):
+    """Return the embeddings of an upload as a (n_chunks, dim) float32 matrix.
+
+    Binary embeddings are checked one by one against the dimension, then
+    concatenated and decoded with a single frombuffer call. JSON float lists
+    are converted in one step as a fallback.
+    """
+    chunks = document.chunks
+    if not chunks:
+        return np.empty((0, document.embeddingDim or 0), dtype=EMBEDDING_DTYPE)
+
+    if all(chunk.embedding_b64 is not None for chunk in chunks):
+        raws = [_decode_bytes(chunk.embedding_b64) for chunk in chunks]
+        dim = document.embeddingDim or len(raws[0]) // EMBEDDING_DTYPE.itemsize
+        if dim == 0:
+            raise _invalid("Binary embeddings are empty")
+        for chunk, raw in zip(chunks, raws):
+            if len(raw) != dim * EMBEDDING_DTYPE.itemsize:
+                raise _invalid(f"Embedding of chunk {chunk.id} does not have dimension {dim}")
+        return np.frombuffer(b''.join(raws), dtype=EMBEDDING_DTYPE).reshape(len(chunks), dim)
+
+    if any(chunk.embedding is None for chunk in chunks):
+        raise _invalid("Every chunk needs either embedding or embedding_b64")
+    return _float_matrix([chunk.embedding for chunk in chunks], document.embeddingDim)
+
+
+def query_embedding(request):
+    """Return the query embedding of a request as a float32 vector."""
+    if request.query_embedding_b64 is not None:
+        return decode_embedding(request.query_embedding_b64, request.embedding_dim)
+    if request.query_embedding is None:
+        raise _invalid("Either query_embedding or query_embedding_b64 is required")
+    return _float_matrix([request.query_embedding], request.embedding_dim)[0]
+
+
+def query_embeddings(request):
+    """Return the query embeddings of a batch request as a (n_queries, dim) float32 matrix."""
+    if request.query_embeddings_b64 is not None:
+        vectors = [decode_embedding(encoded, request.embedding_dim) for encoded in request.query_embeddings_b64]
+        if not vectors:
+            return np.empty((0, request.embedding_dim or 0), dtype=EMBEDDING_DTYPE)
+        if len({vector.shape[0] for vector in vectors}) > 1:
+            raise _invalid("Embeddings do not all have the same dimension")
+        return np.vstack(vectors)
+    if request.query_embeddings is None:
+        raise _invalid("Either query_embeddings or query_embeddings_b64 is required")
+    return _float_matrix(request.query_embeddings, request.embedding_dim)
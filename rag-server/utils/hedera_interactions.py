@@ -1,107 +1,95 @@
-import os
-import json
 from web3 import Web3
-from dotenv import load_dotenv
-import time
+from state import SharedState
+from utils.metrics import timed, chain_transaction
 
-load_dotenv()
-
-KEY_CONTRACT_ADDRESS = os.getenv('KEY_CONTRACT_ADDRESS')
 
 def getRequestedKeys():
-    # Convert the address to checksum format
-    address = Web3.to_checksum_address(KEY_CONTRACT_ADDRESS)
-    
-    # Load the ABI from the JSON file
-    with open('./contract/KeyContract.json') as f:
-        abi = json.load(f)['abi']
-    
-    # Initialize a Web3 instance
-    web3 = Web3(Web3.HTTPProvider(os.getenv("RELAY_ENDPOINT")))
-    
-    # Add the operator's private key to the wallet
-    wallet = web3.eth.account.from_key(os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Initialize the contract
-    KeyContract = web3.eth.contract(address=address, abi=abi)
-    
+    gateway = SharedState.gateway
+
     # Call the contract method
-    call_res = KeyContract.functions.getChunkKeys(["1", "2"]).call({'from': wallet.address, 'gas': 300000})
-    
+    call_res = gateway.call(gateway.functions.getChunkKeys(["1", "2"]))
+
     # Print the result of the contract call
     print(f"Contract call result: {call_res}")
 
 
+# requestChunkKeys stores every chunk id and its price on-chain, so gas grows with the ids
+REQUEST_BASE_GAS = 100000
+REQUEST_GAS_PER_CHUNK = 90000
+
+
 async def request_chunk_keys(chunk_ids, prices, key_server_public_key):
-    # Convert the address to checksum format
-    address = Web3.to_checksum_address(KEY_CONTRACT_ADDRESS)
-    
-    # Load the ABI from the JSON file
-    with open('./contract/KeyContract.json') as f:
-        abi = json.load(f)['abi']
-    
-    # Initialize a Web3 instance
-    web3 = Web3(Web3.HTTPProvider(os.getenv("RELAY_ENDPOINT")))
-    
-    # Add the operator's private key to the wallet
-    wallet = web3.eth.account.from_key(os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Initialize the contract
-    KeyContract = web3.eth.contract(address=address, abi=abi)
-    
-    # Prepare the transaction
-    transaction = KeyContract.functions.requestChunkKeys(chunk_ids, prices, key_server_public_key).build_transaction({
-        'from': wallet.address,
-        'gas': 600000,
-        'nonce': web3.eth.get_transaction_count(wallet.address)
-    })
-    
-    # Sign the transaction with the operator's private key
-    signed_tx = web3.eth.account.sign_transaction(transaction, private_key=os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Send the transaction and wait for the result
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
-    tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-    
+    gateway = SharedState.gateway
+
+    # Send the transaction and await the receipt without blocking the event loop
+    with timed("request_chunk_keys"), chain_transaction("requestChunkKeys"):
+        tx_receipt = await gateway.transact_async(
+            gateway.async_functions.requestChunkKeys(chunk_ids, prices, key_server_public_key),
+            REQUEST_BASE_GAS + REQUEST_GAS_PER_CHUNK * len(chunk_ids)
+        )
+
     print(f"Updated call result: {tx_receipt}")
 
+    return tx_receipt
+
+
+async def get_chunk_key_request(key_server_public_key):
+    """Chunk ids of the key server's open on-chain request, empty once it is published."""
+    gateway = SharedState.gateway
+    return await gateway.async_functions.getChunkKeyRequest(key_server_public_key).call()
+
+RATE_KEY_OWNERS = "rateKeyOwners"
+
+# rateKeyOwners loops over its arguments on-chain, so gas grows with the number of entries
+RATE_BATCH_MAX_ENTRIES = 50
+RATE_BASE_GAS = 100000
+RATE_GAS_PER_ENTRY = 30000
+
+
 def rateKeyOwners(keyOwner, rating):
-     # Convert the address to checksum format
-     #Wait 5 seconds for the transaction to be mined
-    time.sleep(10)
-    address = Web3.to_checksum_address(KEY_CONTRACT_ADDRESS)
-    
-    # Load the ABI from the JSON file
-    with open('./contract/KeyContract.json') as f:
-        abi = json.load(f)['abi']
-    
-    # Initialize a Web3 instance
-    web3 = Web3(Web3.HTTPProvider(os.getenv("RELAY_ENDPOINT")))
-    
-    # Add the operator's private key to the wallet
-    wallet = web3.eth.account.from_key(os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Initialize the contract
-    KeyContract = web3.eth.contract(address=address, abi=abi)
-
-    # keyowner array to web3 checksum format
+    """Queue ratings of key owners in the outbox.
+
+    They are sent after RATE_KEY_OWNERS_DELAY seconds, which gives the key-server's
+    publishChunkKeys transaction time to open the ratings on-chain.
+    """
+    # keyowner array to web3 checksum format, invalid addresses fail here rather than in the worker
     keyOwner = [Web3.to_checksum_address(owner) for owner in keyOwner]
+    SharedState.outbox.enqueue(
+        RATE_KEY_OWNERS,
+        {"key_owners": keyOwner, "ratings": [bool(value) for value in rating]},
+        delay=SharedState.RATE_KEY_OWNERS_DELAY
+    )
+
+
+def merge_key_owner_ratings(items):
+    """Outbox merger turning queued ratings into rateKeyOwners batches.
+
+    publishChunkKeys opens one rating per chunk, so every rated chunk keeps its
+    own entry, even when several belong to the same key owner.
+    """
+    gateway = SharedState.gateway
+    batches = []
+    item_ids = []
+    owners = []
+    ratings = []
+
+    def close_batch():
+        if item_ids:
+            batches.append((
+                list(item_ids),
+                gateway.functions.rateKeyOwners(list(owners), list(ratings)),
+                RATE_BASE_GAS + RATE_GAS_PER_ENTRY * len(owners)
+            ))
+        item_ids.clear()
+        owners.clear()
+        ratings.clear()
+
+    for item_id, payload in items:
+        if owners and len(owners) + len(payload["key_owners"]) > RATE_BATCH_MAX_ENTRIES:
+            close_batch()
+        owners.extend(payload["key_owners"])
+        ratings.extend(payload["ratings"])
+        item_ids.append(item_id)
+    close_batch()
 
-    print("KeyOwner: ", keyOwner)
-    print("Rating: ", rating)
-    
-    # Prepare the transaction
-    transaction = KeyContract.functions.rateKeyOwners(keyOwner, rating).build_transaction({
-        'from': wallet.address,
-        'gas': 600000,
-        'nonce': web3.eth.get_transaction_count(wallet.address)
-    })
-    
-    # Sign the transaction with the operator's private key
-    signed_tx = web3.eth.account.sign_transaction(transaction, private_key=os.getenv("OPERATOR_PRIVATE_KEY"))
-    
-    # Send the transaction and wait for the result
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
-    tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-    
-    print(f"Updated call result: {tx_receipt}")
\ No newline at end of file
+    return batches
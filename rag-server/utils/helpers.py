@@ -1,13 +1,22 @@
 import requests
 import base64
+import binascii
 from Crypto.Cipher import AES
 from Crypto.Hash import MD5
 import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
+from utils.streams import Base64StreamDecoder
 
 load_dotenv()
 
 BACKEND_API = os.getenv('BACKEND_API', 'http://localhost:3001')
+DECRYPT_PARALLEL_THRESHOLD = int(os.getenv('DECRYPT_PARALLEL_THRESHOLD', 256))
+DECRYPT_WORKERS = int(os.getenv('DECRYPT_WORKERS', os.cpu_count() or 1))
+# Ciphertext bytes read per step when decrypting a stored document
+PDF_DECRYPT_READ_SIZE = int(os.getenv('PDF_DECRYPT_READ_SIZE', 1024 * 1024))
 
 def get_public_key(token):
     try:
@@ -40,17 +49,20 @@ def test_document_decrypt():
     print("Decryption successful")
     
 
+def derive_key_and_iv(password, salt, key_length, iv_length):
+    """OpenSSL EVP_BytesToKey (MD5) derivation used by CryptoJS passphrase encryption."""
+    salt = bytes(salt)
+    d = d_i = b''
+    while len(d) < key_length + iv_length:
+        d_i = MD5.new(d_i + password.encode() + salt).digest()
+        d += d_i
+    return d[:key_length], d[key_length:key_length+iv_length]
+
+
 def decrypt_pdf_file(encrypted_data, passphrase):
     def unpad(s):
         return s[:-ord(s[len(s)-1:])]
 
-    def derive_key_and_iv(password, salt, key_length, iv_length):
-        d = d_i = b''
-        while len(d) < key_length + iv_length:
-            d_i = MD5.new(d_i + password.encode() + salt).digest()
-            d += d_i
-        return d[:key_length], d[key_length:key_length+iv_length]
-
     salt = encrypted_data[8:16]
     encrypted_data = encrypted_data[16:]
     key, iv = derive_key_and_iv(passphrase, salt, 32, 16)
@@ -58,29 +70,69 @@ def decrypt_pdf_file(encrypted_data, passphrase):
     return base64.b64decode(unpad(cipher.decrypt(encrypted_data)))
 
 
+def decrypt_pdf_to_file(encrypted_path, pdf_path, passphrase, read_size=PDF_DECRYPT_READ_SIZE):
+    """Decrypt a stored document into `pdf_path` with constant memory and return the bytes written.
+
+    Same format as decrypt_pdf_file. The ciphertext is decrypted and base64-decoded
+    piece by piece, holding back the last block until the end to check and strip
+    its padding. The PDF only appears at `pdf_path` once it is complete.
+    """
+    decoder = Base64StreamDecoder()
+    temp_path = f"{pdf_path}.part"
+    written = 0
+    try:
+        with open(encrypted_path, "rb") as encrypted_file, open(temp_path, "wb") as pdf_file:
+            header = encrypted_file.read(16)
+            if len(header) < 16:
+                raise ValueError("Wrong passphrase - data too short")
+            key, iv = derive_key_and_iv(passphrase, header[8:16], 32, 16)
+            cipher = AES.new(key, AES.MODE_CBC, iv)
+
+            held = b''
+            while True:
+                data = encrypted_file.read(read_size)
+                if not data:
+                    break
+                data = held + data
+                # Keep at least the final block back, it carries the padding
+                cut = (len(data) - 1) // 16 * 16
+                held = data[cut:]
+                plain = decoder.decode(cipher.decrypt(data[:cut]))
+                pdf_file.write(plain)
+                written += len(plain)
+
+            if len(held) != 16:
+                raise ValueError("Wrong passphrase - data too short" if not held else "Ciphertext is not block aligned")
+            last = cipher.decrypt(held)
+            padding_length = last[-1]
+            if padding_length > 16 or padding_length < 1 or last[-padding_length:] != bytes([padding_length]) * padding_length:
+                raise ValueError("Wrong passphrase - padding error")
+            plain = decoder.decode(last[:-padding_length]) + decoder.flush()
+            pdf_file.write(plain)
+            written += len(plain)
+        os.replace(temp_path, pdf_path)
+    except binascii.Error as e:
+        # A wrong key usually yields bytes outside the base64 alphabet long before the padding
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise ValueError("Wrong passphrase - decoding error") from e
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
+
+
 def decrypt(encrypted_data, passphrase):
+    """Decrypt one chunk from its raw OpenSSL-format ciphertext (`Salted__`, salt, data)."""
     def unpad(s):
-        try:
-            padding_length = ord(s[len(s)-1:])
-            if padding_length > 16 or padding_length < 1:
-                raise ValueError("Invalid padding")
-            for i in range(padding_length):
-                if ord(s[len(s)-1-i:len(s)-i]) != padding_length:
-                    raise ValueError("Invalid padding")
-            return s[:-padding_length]
-        except:
+        padding_length = s[-1] if s else 0
+        if padding_length > 16 or padding_length < 1 or s[-padding_length:] != bytes([padding_length]) * padding_length:
             raise ValueError("Wrong passphrase - padding error")
-
-    def derive_key_and_iv(password, salt, key_length, iv_length):
-        d = d_i = b''
-        while len(d) < key_length + iv_length:
-            d_i = MD5.new(d_i + password.encode() + salt).digest()
-            d += d_i
-        return d[:key_length], d[key_length:key_length+iv_length]
+        return s[:-padding_length]
 
     try:
-        encrypted_data = base64.b64decode(encrypted_data)
-        if len(encrypted_data) < 16:
+        if encrypted_data is None or len(encrypted_data) < 16:
             raise ValueError("Wrong passphrase - data too short")
             
         salt = encrypted_data[8:16]
@@ -93,4 +145,67 @@ def decrypt(encrypted_data, passphrase):
     except Exception as e:
         if "Wrong passphrase" in str(e):
             raise
-        raise ValueError("Wrong passphrase - decryption error")
\ No newline at end of file
+        raise ValueError("Wrong passphrase - decryption error")
+
+
+def index_keys(keys):
+    """Map the key-server response to {chunk_id: secret_key} for O(1) lookups."""
+    return {key["chunk_id"]: key["secret_key"] for key in keys}
+
+
+def _decrypt_batch(triples):
+    decrypted = {}
+    failures = {}
+    for chunk_id, encrypted_data, passphrase in triples:
+        if passphrase is None:
+            failures[chunk_id] = "No key returned for chunk"
+            continue
+        try:
+            decrypted[chunk_id] = decrypt(encrypted_data, passphrase)
+        except ValueError as e:
+            failures[chunk_id] = str(e)
+    return decrypted, failures
+
+
+_decrypt_pool = None
+_decrypt_pool_lock = threading.Lock()
+
+def _get_decrypt_pool():
+    global _decrypt_pool
+    with _decrypt_pool_lock:
+        if _decrypt_pool is None:
+            # Forking the multi-threaded server could copy locks held by other threads into
+            # the workers, spawned workers start from a fresh interpreter instead
+            _decrypt_pool = ProcessPoolExecutor(
+                max_workers=DECRYPT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _decrypt_pool
+
+
+def shutdown_decrypt_pool():
+    """Stop the decryption workers, if any were started."""
+    global _decrypt_pool
+    with _decrypt_pool_lock:
+        if _decrypt_pool is not None:
+            _decrypt_pool.shutdown()
+            _decrypt_pool = None
+
+
+def decrypt_chunks(triples):
+    """Decrypt many (chunk_id, encrypted_data, passphrase) triples.
+
+    Small batches are decrypted inline, large ones are split across a process
+    pool. Returns a tuple of ({chunk_id: plaintext}, {chunk_id: error}).
+    """
+    triples = list(triples)
+    if len(triples) < DECRYPT_PARALLEL_THRESHOLD or DECRYPT_WORKERS < 2:
+        return _decrypt_batch(triples)
+
+    slices = [triples[i::DECRYPT_WORKERS] for i in range(DECRYPT_WORKERS)]
+    decrypted = {}
+    failures = {}
+    for batch_decrypted, batch_failures in _get_decrypt_pool().map(_decrypt_batch, slices):
+        decrypted.update(batch_decrypted)
+        failures.update(batch_failures)
+    return decrypted, failures
@@ -0,0 +1,142 @@
+import asyncio
+from fastapi import HTTPException
+from utils.hedera_interactions import request_chunk_keys, get_chunk_key_request
+from utils.metrics import timed
+from state import SharedState
+
+
+class KeyRequestBroker:
+    """Coalesces encrypted-chunk key requests from concurrent queries.
+
+    Requests arriving within `window_seconds` of each other are grouped by key
+    server, sent as one requestChunkKeys transaction per group and resolved with
+    a single key-server call. Each caller only receives the keys it asked for.
+    A batch holds at most `max_batch_size` chunk ids, which bounds the gas of the
+    request and of its publication. Larger requests are split over several batches.
+
+    requestChunkKeys overwrites the previous request of a key server, and the
+    key server's publishChunkKeys, which pays the key owners and opens their
+    ratings, only succeeds for the current request. The next batch for a key
+    server is therefore only requested once the previous one is published, or
+    after `publication_timeout` seconds.
+    """
+
+    def __init__(self, window_seconds=0.05, max_batch_size=200, publication_timeout=120.0,
+                 publication_poll_interval=1.0):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.publication_timeout = publication_timeout
+        self.publication_poll_interval = publication_poll_interval
+        self._pending = {}
+        self._flush_tasks = {}
+        # One batch per key server in flight, from its request until its publication
+        self._locks = {}
+
+    async def request_keys(self, chunk_ids, prices, key_server_public_key):
+        size = self.max_batch_size
+        if len(chunk_ids) > size:
+            parts = await asyncio.gather(*(
+                self.request_keys(chunk_ids[i:i + size], prices[i:i + size], key_server_public_key)
+                for i in range(0, len(chunk_ids), size)
+            ))
+            return [key for part in parts for key in part]
+
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(key_server_public_key, [])
+        batch.append((chunk_ids, prices, future))
+
+        if sum(len(ids) for ids, _, _ in batch) >= self.max_batch_size:
+            self._schedule_flush(key_server_public_key, delay=0)
+        elif key_server_public_key not in self._flush_tasks:
+            self._schedule_flush(key_server_public_key, delay=self.window_seconds)
+
+        return await future
+
+    def pending_chunk_count(self):
+        """Number of chunk ids queued for the next batches, across all key servers."""
+        return sum(len(ids) for batch in self._pending.values() for ids, _, _ in batch)
+
+    def _schedule_flush(self, key_server_public_key, delay):
+        previous = self._flush_tasks.pop(key_server_public_key, None)
+        if previous is not None:
+            previous.cancel()
+        self._flush_tasks[key_server_public_key] = asyncio.create_task(self._flush_after(key_server_public_key, delay))
+
+    async def _flush_after(self, key_server_public_key, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        # Detach the batch before awaiting so new requests start the next window
+        self._flush_tasks.pop(key_server_public_key, None)
+        batch, rest = self._take_batch(self._pending.pop(key_server_public_key, []))
+        if rest:
+            # Sent as soon as the key server's lock is free
+            self._pending[key_server_public_key] = rest
+            self._schedule_flush(key_server_public_key, delay=0)
+        if batch:
+            await self._flush(key_server_public_key, batch)
+
+    def _take_batch(self, pending):
+        """Split queued requests into a batch of at most max_batch_size distinct ids and the rest."""
+        batch, rest = [], []
+        chunk_ids = set()
+        for entry in pending:
+            merged = chunk_ids.union(entry[0])
+            if rest or (batch and len(merged) > self.max_batch_size):
+                rest.append(entry)
+            else:
+                batch.append(entry)
+                chunk_ids = merged
+        return batch, rest
+
+    async def _flush(self, key_server_public_key, batch):
+        # Deduplicate chunk ids across queries, keeping the highest offered price
+        merged = {}
+        for chunk_ids, prices, _ in batch:
+            for chunk_id, price in zip(chunk_ids, prices):
+                merged[chunk_id] = max(price, merged.get(chunk_id, price))
+        chunk_ids = list(merged)
+
+        lock = self._locks.setdefault(key_server_public_key, asyncio.Lock())
+        async with lock:
+            try:
+                receipt = await request_chunk_keys(chunk_ids, [merged[chunk_id] for chunk_id in chunk_ids], key_server_public_key)
+
+                # The receipt block lets the key server check the request against its log index
+                with timed("key_server_fetch"):
+                    response = await SharedState.http_client.post(f"{SharedState.KEY_SERVER_API}/get-keys/",
+                                          json={"chunk_ids": chunk_ids, "whole_document": False,
+                                                "request_block": receipt["blockNumber"]})
+
+                if response.status_code != 200:
+                    raise HTTPException(status_code=response.status_code, detail=response.text)
+
+                keys_by_chunk = {key["chunk_id"]: key for key in response.json()}
+            except Exception as e:
+                # Without keys the key server has queued no publication to wait for
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            # Callers get their keys right away, only the next batch waits for the publication
+            for requested_ids, _, future in batch:
+                if not future.done():
+                    future.set_result([keys_by_chunk[chunk_id] for chunk_id in requested_ids if chunk_id in keys_by_chunk])
+
+            with timed("await_publication"):
+                await self._await_publication(key_server_public_key)
+
+    async def _await_publication(self, key_server_public_key):
+        """Poll until publishChunkKeys has cleared the key server's on-chain request."""
+        deadline = asyncio.get_running_loop().time() + self.publication_timeout
+        while True:
+            try:
+                if not await get_chunk_key_request(key_server_public_key):
+                    return True
+            except Exception as e:
+                print(f"Could not read the chunk key request of {key_server_public_key}: {e}")
+            if asyncio.get_running_loop().time() >= deadline:
+                print(f"Chunk keys of {key_server_public_key} not published after {self.publication_timeout}s, "
+                      "sending the next request anyway")
+                return False
+            await asyncio.sleep(self.publication_poll_interval)
@@ -0,0 +1,66 @@
+"""Prometheus metrics of the rag-server, exposed in text format on /metrics."""
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+# Covers everything from in-memory lookups to on-chain receipt waits
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "rag_http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds", "Latency of the individual stages of request processing",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+CHAIN_TRANSACTIONS = Counter(
+    "rag_chain_transactions_total", "Contract transactions sent, by contract function and outcome",
+    ["function", "outcome"]
+)
+OUTBOX_ITEMS = Gauge(
+    "rag_outbox_items", "Contract transactions in the outbox, by kind and status", ["kind", "status"]
+)
+PENDING_KEY_REQUESTS = Gauge(
+    "rag_pending_key_request_chunks", "Chunk ids waiting in the key request broker for the next batch"
+)
+QUERY_CACHE_REQUESTS = Counter(
+    "rag_query_cache_requests_total", "Vector searches answered from the query result cache or run on the index",
+    ["result"]
+)
+PDF_CACHE_REQUESTS = Counter(
+    "rag_pdf_cache_requests_total", "Decrypted PDF downloads served from the cache or decrypted again",
+    ["result"]
+)
+PDF_CACHE_BYTES = Gauge(
+    "rag_pdf_cache_bytes", "Size of the decrypted PDFs currently kept on disk"
+)
+BLOB_UPLOADS = Counter(
+    "rag_blob_uploads_total", "Encrypted document uploads, by whether the blob was new or already stored",
+    ["result"]
+)
+BLOB_STORE_BYTES = Gauge(
+    "rag_blob_store_bytes", "Size of the distinct encrypted document blobs, as of the last garbage collection"
+)
+
+
+@contextmanager
+def timed(stage):
+    """Record the duration of the enclosed block under `stage`, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def chain_transaction(function):
+    """Count the enclosed contract transaction as a success or failure of `function`."""
+    try:
+        yield
+    except BaseException:
+        CHAIN_TRANSACTIONS.labels(function, "failure").inc()
+        raise
+    CHAIN_TRANSACTIONS.labels(function, "success").inc()
+
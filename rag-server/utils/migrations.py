@@ -0,0 +1,120 @@
+"""Versioned schema migrations for the rag-server DuckDB database.
+
+Every migration runs once, in its own transaction, and is recorded in
+`schema_version`. Append new migrations to MIGRATIONS with the next version
+number; never edit or reorder ones that have already shipped.
+"""
+from utils.db import transaction
+from utils.document_stats import refresh_document_stats
+from chainshare_common.outbox import OUTBOX_SCHEMA
+from utils.pdf_cache import PDF_CACHE_SCHEMA
+from utils.blob_store import BLOB_STORE_SCHEMA, STAGED_BLOB_SCHEMA
+
+
+def _add_lookup_indexes(conn):
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chunks_public_key ON chunks(public_key);
+        CREATE INDEX IF NOT EXISTS idx_chunks_document_id ON chunks(document_id);
+        CREATE INDEX IF NOT EXISTS idx_documents_document_name ON documents(document_name);
+    """)
+
+
+def _unique_ratings(conn):
+    # Concurrent first ratings could insert the same (chunk, user) twice, only the
+    # latest survives. DuckDB indexes still see rows deleted in the same
+    # transaction, so the table is rebuilt rather than deduplicated in place.
+    duplicates = conn.execute("""
+        SELECT COUNT(*) - COUNT(DISTINCT (chunk_id, public_key)) FROM ratings
+    """).fetchone()[0]
+
+    conn.execute("""
+        CREATE TEMP TABLE ratings_latest AS
+        SELECT rating_id, public_key, chunk_id, rating
+        FROM ratings
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY chunk_id, public_key
+            ORDER BY COALESCE(TRY_CAST(rating_id AS DOUBLE), 0) DESC, rating_id DESC
+        ) = 1;
+        DROP TABLE ratings;
+        CREATE TABLE ratings (
+            rating_id VARCHAR PRIMARY KEY,
+            public_key VARCHAR NOT NULL,
+            chunk_id VARCHAR NOT NULL,
+            rating INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (chunk_id, public_key)
+        );
+        INSERT INTO ratings SELECT * FROM ratings_latest;
+        DROP TABLE ratings_latest;
+    """)
+
+    if duplicates:
+        document_ids = [row[0] for row in conn.execute("SELECT DISTINCT document_id FROM chunks").fetchall()]
+        refresh_document_stats(conn, document_ids)
+
+
+def _chain_outbox(conn):
+    conn.execute(OUTBOX_SCHEMA)
+
+
+def _decrypted_pdf_cache(conn):
+    conn.execute(PDF_CACHE_SCHEMA)
+
+
+def _binary_ciphertext(conn):
+    # Encrypted chunks kept their base64 ciphertext in `content`. It moves to a
+    # BLOB column, and `content` only holds plaintext from now on. Values that
+    # are not valid base64 could never be decrypted and are left NULL.
+    conn.execute("""
+        ALTER TABLE chunks ADD COLUMN IF NOT EXISTS ciphertext BLOB;
+        UPDATE chunks
+        SET
+            ciphertext = CASE
+                WHEN regexp_full_match(content, '[A-Za-z0-9+/]*={0,2}') AND length(content) % 4 = 0
+                THEN from_base64(content)
+            END,
+            content = NULL
+        WHERE encrypted;
+    """)
+
+
+def _blob_store(conn):
+    # Existing .raw files are moved in by BlobStore.adopt_legacy_files at startup
+    conn.execute(BLOB_STORE_SCHEMA)
+
+
+def _staged_blobs(conn):
+    conn.execute(STAGED_BLOB_SCHEMA)
+
+
+MIGRATIONS = [
+    (1, "Lookup indexes on chunks and documents", _add_lookup_indexes),
+    (2, "One rating per chunk and user", _unique_ratings),
+    (3, "Outbox for contract transactions", _chain_outbox),
+    (4, "Decrypted PDF cache entries", _decrypted_pdf_cache),
+    (5, "Binary chunk ciphertext", _binary_ciphertext),
+    (6, "Content-addressed document blobs", _blob_store),
+    (7, "Staged document blobs", _staged_blobs),
+]
+
+
+def run_migrations(conn):
+    """Apply every migration newer than the database's schema version."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT current_timestamp
+        )
+    """)
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        with transaction(conn):
+            migrate(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+        print(f"Applied schema migration {version}: {description}")
@@ -0,0 +1,196 @@
+"""Size-bounded cache of decrypted document PDFs.
+
+Buying a document records it in `decrypted_pdfs` and decrypts its blob from
+the blob store to `{document_id}.pdf`. Every download refreshes the entry's access
+time. Once the cached PDFs exceed the byte budget, the least recently used ones
+are deleted. A download of an evicted PDF decrypts it again with the document
+key from the key-server.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+from utils.db import transaction
+from utils.document_keys import fetch_document_key
+from utils.helpers import decrypt_pdf_to_file
+from utils.metrics import PDF_CACHE_BYTES, PDF_CACHE_REQUESTS, timed
+
+PDF_CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS decrypted_pdfs (
+        document_id VARCHAR PRIMARY KEY,
+        cached BOOLEAN NOT NULL,
+        size BIGINT NOT NULL,
+        last_access DOUBLE NOT NULL
+    )
+"""
+
+
+class PdfCache:
+    """Decrypted PDFs of bought documents, kept within `max_bytes` on disk.
+
+    PDFs accessed within the last `min_age` seconds are never evicted, so a file
+    is not removed while its download is starting. Concurrent misses for the same
+    document share one decryption.
+    """
+
+    def __init__(self, conn, storage_path, blob_store, max_bytes, min_age=60.0):
+        self.conn = conn
+        self.storage_path = storage_path
+        self.blob_store = blob_store
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self._mutex = threading.Lock()
+        self._inflight = {}
+
+    def pdf_path(self, document_id):
+        return os.path.join(self.storage_path, f"{document_id}.pdf")
+
+    def sync(self):
+        """Reconcile the table with the files on disk, then enforce the budget.
+
+        PDFs written before the cache existed are adopted as bought documents.
+        """
+        cursor = self.conn.cursor()
+        try:
+            on_disk = {}
+            for name in os.listdir(self.storage_path):
+                if name.endswith(".pdf"):
+                    stat = os.stat(os.path.join(self.storage_path, name))
+                    on_disk[name[:-len(".pdf")]] = (stat.st_size, stat.st_mtime)
+            entries = cursor.execute("SELECT document_id FROM decrypted_pdfs WHERE cached").fetchall()
+            with transaction(cursor):
+                for (document_id,) in entries:
+                    if document_id not in on_disk:
+                        self._set_uncached(cursor, document_id)
+                for document_id, (size, mtime) in on_disk.items():
+                    cursor.execute("""
+                        INSERT INTO decrypted_pdfs (document_id, cached, size, last_access)
+                        VALUES (?, TRUE, ?, ?)
+                        ON CONFLICT (document_id) DO UPDATE SET cached = TRUE, size = excluded.size
+                    """, (document_id, size, mtime))
+            self._evict(cursor)
+        finally:
+            cursor.close()
+
+    def store(self, document_id, passphrase):
+        """Record a purchase and decrypt the PDF into the cache."""
+        self._load(document_id, passphrase)
+
+    def get(self, document_id):
+        """Path of the decrypted PDF of a bought document, or None if it was never bought."""
+        cursor = self.conn.cursor()
+        try:
+            # Touched before the file check so a concurrent eviction skips it
+            with transaction(cursor):
+                row = cursor.execute("""
+                    UPDATE decrypted_pdfs SET last_access = ? WHERE document_id = ?
+                    RETURNING cached
+                """, (time.time(), document_id)).fetchone()
+            if row is None:
+                return None
+            path = self.pdf_path(document_id)
+            if row[0] and os.path.exists(path):
+                PDF_CACHE_REQUESTS.labels("hit").inc()
+                return path
+        finally:
+            cursor.close()
+
+        PDF_CACHE_REQUESTS.labels("miss").inc()
+        return self._load(document_id)
+
+    def discard(self, document_id):
+        """Forget a deleted document and remove its PDF."""
+        cursor = self.conn.cursor()
+        try:
+            with transaction(cursor):
+                cursor.execute("DELETE FROM decrypted_pdfs WHERE document_id = ?", [document_id])
+            path = self.pdf_path(document_id)
+            if os.path.exists(path):
+                os.remove(path)
+            self._update_gauge(cursor)
+        finally:
+            cursor.close()
+
+    def _load(self, document_id, passphrase=None):
+        # The first caller decrypts, callers arriving meanwhile wait for its result
+        with self._mutex:
+            future = self._inflight.get(document_id)
+            owner = future is None
+            if owner:
+                future = self._inflight[document_id] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            path = self._materialize(document_id, passphrase)
+            future.set_result(path)
+            return path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._mutex:
+                del self._inflight[document_id]
+
+    def _materialize(self, document_id, passphrase):
+        if passphrase is None:
+            passphrase = fetch_document_key(document_id)
+        encrypted_path = self.blob_store.document_path(document_id)
+        if encrypted_path is None:
+            raise FileNotFoundError(f"No encrypted blob stored for document {document_id}")
+        path = self.pdf_path(document_id)
+        with timed("decrypt_pdf"):
+            size = decrypt_pdf_to_file(encrypted_path, path, passphrase)
+
+        cursor = self.conn.cursor()
+        try:
+            with transaction(cursor):
+                cursor.execute("""
+                    INSERT INTO decrypted_pdfs (document_id, cached, size, last_access)
+                    VALUES (?, TRUE, ?, ?)
+                    ON CONFLICT (document_id) DO UPDATE SET
+                        cached = TRUE,
+                        size = excluded.size,
+                        last_access = excluded.last_access
+                """, (document_id, size, time.time()))
+            self._evict(cursor)
+        finally:
+            cursor.close()
+        return path
+
+    def _evict(self, cursor):
+        entries = cursor.execute("""
+            SELECT document_id, size, last_access
+            FROM decrypted_pdfs
+            WHERE cached
+            ORDER BY last_access
+        """).fetchall()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.min_age
+        for document_id, size, last_access in entries:
+            if total <= self.max_bytes or last_access > cutoff:
+                break
+            # Skipped if a download touched the entry since it was selected
+            with transaction(cursor):
+                evicted = cursor.execute("""
+                    UPDATE decrypted_pdfs SET cached = FALSE, size = 0
+                    WHERE document_id = ? AND cached AND last_access <= ?
+                    RETURNING document_id
+                """, (document_id, cutoff)).fetchone()
+            if evicted is None:
+                continue
+            path = self.pdf_path(document_id)
+            if os.path.exists(path):
+                os.remove(path)
+            total -= size
+        PDF_CACHE_BYTES.set(total)
+
+    def _set_uncached(self, cursor, document_id):
+        cursor.execute(
+            "UPDATE decrypted_pdfs SET cached = FALSE, size = 0 WHERE document_id = ?", [document_id]
+        )
+
+    def _update_gauge(self, cursor):
+        PDF_CACHE_BYTES.set(
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM decrypted_pdfs WHERE cached").fetchone()[0]
+        )
@@ -0,0 +1,98 @@
+"""In-memory cache of vector search results for repeated query embeddings.
+
+Entries map a query embedding and `n_results` to the chunk ids and distances
+the vector index returned. Embeddings are quantized before hashing, so tiny
+float differences between clients map to the same entry. Every upload or
+deletion bumps the corpus version, which invalidates all earlier entries.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from utils.metrics import QUERY_CACHE_REQUESTS
+
+
+class QueryCache:
+    """LRU and TTL bounded search results, optionally matched by cosine similarity.
+
+    With `similarity` set, a query without an exact entry reuses the entry of the
+    most similar cached embedding if their cosine similarity is at least
+    `similarity`. The reused distances are those of the cached embedding.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300.0, quantum=1e-4, similarity=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.quantum = quantum
+        self.similarity = similarity
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump_version(self):
+        """Record a change of the indexed chunks, all cached results become stale."""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def _key(self, embedding, n_results):
+        quantized = np.rint(np.asarray(embedding, dtype=np.float64) / self.quantum).astype(np.int64)
+        return n_results, hashlib.blake2b(quantized.tobytes(), digest_size=16).digest()
+
+    def get(self, embedding, n_results):
+        """(ids, distances) of a cached search, or None."""
+        if self.max_entries <= 0:
+            return None
+        key = self._key(embedding, n_results)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                QUERY_CACHE_REQUESTS.labels("hit").inc()
+                return entry[2], entry[3]
+            if entry is not None:
+                del self._entries[key]
+
+            if self.similarity:
+                key = self._most_similar(embedding, n_results, now)
+                if key is not None:
+                    self._entries.move_to_end(key)
+                    entry = self._entries[key]
+                    QUERY_CACHE_REQUESTS.labels("similar_hit").inc()
+                    return entry[2], entry[3]
+        QUERY_CACHE_REQUESTS.labels("miss").inc()
+        return None
+
+    def put(self, embedding, n_results, ids, distances, version):
+        """Cache a search result, unless the corpus changed since `version` was read."""
+        if self.max_entries <= 0:
+            return
+        key = self._key(embedding, n_results)
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        unit = vector / norm if norm else vector
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, unit, tuple(ids), tuple(distances))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _most_similar(self, embedding, n_results, now):
+        # Caller holds the lock. Linear in the number of entries, which max_entries bounds
+        keys = [
+            key for key, entry in self._entries.items()
+            if key[0] == n_results and entry[0] > now and len(entry[1]) == len(embedding)
+        ]
+        if not keys:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        similarities = np.stack([self._entries[key][1] for key in keys]) @ (vector / norm)
+        best = int(np.argmax(similarities))
+        return keys[best] if similarities[best] >= self.similarity else None
@@ -0,0 +1,53 @@
+import base64
+import os
+
+
+class Base64StreamDecoder:
+    """Incrementally decodes base64 input that arrives in arbitrarily sized pieces."""
+
+    def __init__(self):
+        self._pending = b''
+
+    def decode(self, data):
+        # Whitespace and line breaks are not part of the encoded payload
+        data = self._pending + bytes(data).translate(None, b' \t\r\n')
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        if not usable:
+            return b''
+        return base64.b64decode(data[:usable], validate=True)
+
+    def flush(self):
+        if self._pending:
+            raise ValueError("Truncated base64 input")
+        return b''
+
+
+async def write_stream_to_file(chunks, path, decode_base64=False, digest=None):
+    """Write an async byte stream to `path` piece by piece and return the byte count.
+
+    The data is written to a temporary file first and only moved into place once
+    the stream has been consumed completely, so readers never see partial files.
+    A hashlib `digest` is updated with the written bytes.
+    """
+    decoder = Base64StreamDecoder() if decode_base64 else None
+    temp_path = f"{path}.part"
+    written = 0
+    try:
+        with open(temp_path, "wb") as f:
+            async for chunk in chunks:
+                if decoder:
+                    chunk = decoder.decode(chunk)
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            if decoder:
+                decoder.flush()
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
@@ -0,0 +1,245 @@
+import fcntl
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import numpy as np
+
+
+class VectorIndex(ABC):
+    """Interface of the vector stores behind SharedState.vector_index.
+
+    `query` returns Chroma-shaped results: {"ids": [[...]], "distances": [[...]]}
+    with one list per query embedding, distances being squared L2.
+    """
+
+    @abstractmethod
+    def add(self, ids, embeddings):
+        """Add embeddings under the given chunk ids."""
+
+    @abstractmethod
+    def query(self, query_embeddings, n_results):
+        """Nearest `n_results` chunks of every query embedding."""
+
+    @abstractmethod
+    def delete(self, ids):
+        """Remove the embeddings of the given chunk ids."""
+
+    @abstractmethod
+    def count(self):
+        """Number of embeddings in the index."""
+
+
+class ChromaVectorIndex(VectorIndex):
+    """Vector index backed by a persistent Chroma collection."""
+
+    def __init__(self, path, collection_name):
+        import chromadb
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection = self.client.get_or_create_collection(name=collection_name)
+
+    def add(self, ids, embeddings):
+        self.collection.add(ids=ids, embeddings=embeddings)
+
+    def query(self, query_embeddings, n_results):
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            include=["distances"]
+        )
+        return {"ids": results["ids"], "distances": results["distances"]}
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def count(self):
+        return self.collection.count()
+
+
+class MmapVectorIndex(VectorIndex):
+    """Exact-search index over a memory-mapped float32 matrix.
+
+    Layout of `path`:
+      meta.json        embedding dimension
+      vectors.f32      row-major float32 embeddings, append-only
+      norms.f32        squared L2 norm per row, append-only
+      ids.txt          chunk id per row, one per line; appended last, so its
+                       line count is the number of committed rows
+      tombstones.txt   deleted row numbers, one per line
+
+    Files are only ever appended to, which lets several worker processes map the
+    same vectors through the page cache and pick up new rows by re-reading the
+    tails of ids.txt and tombstones.txt.
+    """
+
+    BLOCK_ROWS = 65536
+
+    def __init__(self, path, dim=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, "meta.json")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._norms_path = os.path.join(path, "norms.f32")
+        self._ids_path = os.path.join(path, "ids.txt")
+        self._tombstones_path = os.path.join(path, "tombstones.txt")
+        self._lock_path = os.path.join(path, ".lock")
+
+        self.dim = dim
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        self._ids = []
+        self._row_by_id = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self._ids_offset = 0
+        self._tombstones_offset = 0
+        self._vectors = None
+        self._norms = None
+        self._mapped_rows = 0
+        # Guards the in-memory view, which request threads refresh concurrently
+        self._state_lock = threading.Lock()
+
+    @contextmanager
+    def _write_lock(self):
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Pick up rows and tombstones appended since the last call, possibly by other processes."""
+        with self._state_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+
+        if os.path.exists(self._ids_path) and os.path.getsize(self._ids_path) > self._ids_offset:
+            with open(self._ids_path, "rb") as f:
+                f.seek(self._ids_offset)
+                data = f.read()
+            # Only consume complete lines, a writer may be mid-append
+            data = data[:data.rfind(b"\n") + 1]
+            self._ids_offset += len(data)
+            new_ids = data.decode().splitlines()
+            first_row = len(self._ids)
+            self._ids.extend(new_ids)
+            self._alive = np.concatenate([self._alive, np.ones(len(new_ids), dtype=bool)])
+            for row, chunk_id in enumerate(new_ids, start=first_row):
+                # A re-added id supersedes its earlier row
+                previous = self._row_by_id.get(chunk_id)
+                if previous is not None:
+                    self._alive[previous] = False
+                self._row_by_id[chunk_id] = row
+
+        if os.path.exists(self._tombstones_path) and os.path.getsize(self._tombstones_path) > self._tombstones_offset:
+            with open(self._tombstones_path, "rb") as f:
+                f.seek(self._tombstones_offset)
+                data = f.read()
+            data = data[:data.rfind(b"\n") + 1]
+            self._tombstones_offset += len(data)
+            for line in data.decode().splitlines():
+                row = int(line)
+                if row < len(self._alive):
+                    self._alive[row] = False
+                    chunk_id = self._ids[row]
+                    if self._row_by_id.get(chunk_id) == row:
+                        del self._row_by_id[chunk_id]
+
+        rows = len(self._ids)
+        if rows != self._mapped_rows:
+            if rows:
+                self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+                self._norms = np.memmap(self._norms_path, dtype=np.float32, mode="r", shape=(rows,))
+            self._mapped_rows = rows
+
+    def add(self, ids, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(ids):
+            raise ValueError("Expected one embedding row per id")
+        if any("\n" in chunk_id for chunk_id in ids):
+            raise ValueError("Chunk ids must not contain line breaks")
+
+        with self._write_lock():
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embedding has dimension {embeddings.shape[1]}, expected {self.dim}")
+
+            # Vectors and norms go first, the ids append commits the rows
+            with open(self._vectors_path, "ab") as f:
+                f.write(embeddings.tobytes())
+            with open(self._norms_path, "ab") as f:
+                f.write(np.einsum("ij,ij->i", embeddings, embeddings).astype(np.float32).tobytes())
+            with open(self._ids_path, "ab") as f:
+                f.write("".join(f"{chunk_id}\n" for chunk_id in ids).encode())
+                f.flush()
+                os.fsync(f.fileno())
+        self._refresh()
+
+    def delete(self, ids):
+        with self._write_lock():
+            self._refresh()
+            rows = [self._row_by_id[chunk_id] for chunk_id in ids if chunk_id in self._row_by_id]
+            if rows:
+                with open(self._tombstones_path, "ab") as f:
+                    f.write("".join(f"{row}\n" for row in rows).encode())
+        self._refresh()
+
+    def count(self):
+        self._refresh()
+        return int(self._alive.sum())
+
+    def query(self, query_embeddings, n_results):
+        with self._state_lock:
+            self._refresh_locked()
+            vectors, norms, ids, rows = self._vectors, self._norms, self._ids, self._mapped_rows
+            alive = self._alive[:rows].copy()
+
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        n_queries = queries.shape[0]
+        k = min(n_results, int(alive.sum()))
+        if k == 0:
+            return {"ids": [[] for _ in range(n_queries)], "distances": [[] for _ in range(n_queries)]}
+
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        best_distances = np.full((n_queries, 0), np.inf, dtype=np.float32)
+        best_rows = np.zeros((n_queries, 0), dtype=np.int64)
+
+        for start in range(0, rows, self.BLOCK_ROWS):
+            stop = min(start + self.BLOCK_ROWS, rows)
+            # Squared L2 distance via |x|^2 + |q|^2 - 2 x.q, one matmul per block
+            distances = norms[start:stop][None, :] + query_norms[:, None] - 2.0 * (queries @ vectors[start:stop].T)
+            distances[:, ~alive[start:stop]] = np.inf
+
+            candidates = np.concatenate([best_distances, distances], axis=1)
+            candidate_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, stop), distances.shape)], axis=1)
+            if candidates.shape[1] > k:
+                top = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+                candidates = np.take_along_axis(candidates, top, axis=1)
+                candidate_rows = np.take_along_axis(candidate_rows, top, axis=1)
+            best_distances, best_rows = candidates, candidate_rows
+
+        order = np.argsort(best_distances, axis=1)
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return {
+            "ids": [[ids[row] for row in query_rows] for query_rows in best_rows],
+            "distances": [np.maximum(row, 0.0).tolist() for row in best_distances],
+        }
+
+
+def create_vector_index(backend, chroma_path, collection_name, mmap_path):
+    if backend == "chroma":
+        return ChromaVectorIndex(chroma_path, collection_name)
+    if backend == "mmap":
+        return MmapVectorIndex(mmap_path)
+    raise ValueError(f"Unknown vector backend: {backend}")
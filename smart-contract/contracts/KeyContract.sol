@@ -13,6 +13,11 @@ contract KeyContract {
     mapping(address => uint16) public keyOwnerOpenRatings; //Maps the key owner address to the amount of open ratings
     mapping(address => uint16) public keyOwnerReputation; //Maps the key owner address to the reputation of the key owner
 
+    // Emitted for every state change of a key request, so servers can follow them through logs instead of polling views
+    event ChunkKeysRequested(address indexed keyServer, string[] chunkIds, uint16[] prices);
+    event ChunkKeysPublished(address indexed keyServer, string[] chunkIds, address[] keyOwners);
+    event KeyOwnersRated(address indexed rater, address[] keyOwners, bool[] ratings);
+
     constructor(address _tokenAddress) {
         owner = msg.sender;
         tokenAddress = _tokenAddress;
@@ -27,6 +32,7 @@ contract KeyContract {
         for (uint256 i = 0; i < chunkIds.length; i++) {
             chunkPrices[chunkIds[i]] = prices[i];
         }
+        emit ChunkKeysRequested(keyServerPublicKey, chunkIds, prices);
     }
 
     function publishChunkKeys(
@@ -96,6 +102,7 @@ contract KeyContract {
             }
         }
         delete requestedChunkKeysByKeyServer[msg.sender];
+        emit ChunkKeysPublished(msg.sender, chunkIds, keyOwners);
     }
 
     function rateKeyOwners(
@@ -118,6 +125,7 @@ contract KeyContract {
                 keyOwnerReputation[keyOwners[i]] = 0;
             }
         }
+        emit KeyOwnersRated(msg.sender, keyOwners, ratings);
     }
 
     function getChunkKeyRequest(
@@ -49,4 +49,21 @@ describe("KeyContract", function () {
     });
     expect(rating).to.equal(2);
   });
+
+  it("should emit events for requests, publications and ratings", async function () {
+    const contract = await hre.ethers.getContractAt("KeyContract", contractAddress, signers[0]);
+    const keyServer = signers[0].address;
+
+    await expect(contract.requestChunkKeys(["3", "4"], [5, 0], keyServer))
+      .to.emit(contract, "ChunkKeysRequested")
+      .withArgs(keyServer, ["3", "4"], [5, 0]);
+
+    await expect(contract.publishChunkKeys(["3", "4"], ["key3", "key4"], [keyServer, keyServer]))
+      .to.emit(contract, "ChunkKeysPublished")
+      .withArgs(keyServer, ["3", "4"], [keyServer, keyServer]);
+
+    await expect(contract.rateKeyOwners([keyServer], [true]))
+      .to.emit(contract, "KeyOwnersRated")
+      .withArgs(keyServer, [keyServer], [true]);
+  });
 });